@@ -8,12 +8,17 @@
 from trytond.pool import Pool
 from gift_card import (
     GiftCard, GiftCardReport, GiftCardRedeemStart, GiftCardRedeemDone,
-    GiftCardRedeemWizard
+    GiftCardRedeemWizard, GiftCardReconcileDone, GiftCardReconcileWizard,
+    GiftCardIssueStart, GiftCardIssueDone, GiftCardIssueWizard,
+    GiftCardImportStart, GiftCardImportDone, GiftCardImportWizard,
+    GiftCardLiability, GiftCardBalanceSnapshot
 )
 from sale import SaleLine, Sale, AddSalePaymentView, Payment, AddSalePayment
 from configuration import Configuration, SaleConfiguration
 from gateway import PaymentGateway, PaymentTransaction
 from product import Product, GiftCardPrice
+from user import User, Group
+from invoice import Invoice
 
 
 def register():
@@ -23,6 +28,13 @@ def register():
         GiftCardPrice,
         GiftCardRedeemStart,
         GiftCardRedeemDone,
+        GiftCardReconcileDone,
+        GiftCardIssueStart,
+        GiftCardIssueDone,
+        GiftCardImportStart,
+        GiftCardImportDone,
+        GiftCardLiability,
+        GiftCardBalanceSnapshot,
         SaleConfiguration,
         SaleLine,
         Sale,
@@ -31,6 +43,9 @@ def register():
         PaymentGateway,
         PaymentTransaction,
         Product,
+        User,
+        Group,
+        Invoice,
         module='gift_card', type_='model'
     )
     Pool.register(
@@ -39,6 +54,9 @@ def register():
     )
     Pool.register(
         GiftCardRedeemWizard,
+        GiftCardReconcileWizard,
+        GiftCardIssueWizard,
+        GiftCardImportWizard,
         AddSalePayment,
         module='gift_card', type_='wizard'
     )
@@ -23,6 +23,20 @@ class Configuration(ModelSingleton, ModelSQL, ModelView):
         )
     )
 
+    breakage_account = fields.Property(
+        fields.Many2One(
+            'account.account', 'Breakage Account',
+            domain=[('kind', '=', 'revenue')],
+            help='Account credited with the amount left on expired gift cards'
+        )
+    )
+    breakage_journal = fields.Property(
+        fields.Many2One(
+            'account.journal', 'Breakage Journal',
+            help='Journal of the moves posted for expired gift cards'
+        )
+    )
+
     # This field defines sequnce for the gift card number
     number_sequence = fields.Property(
         fields.Many2One(
@@ -5,9 +5,15 @@
     :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
-from trytond.pool import PoolMeta
+from decimal import Decimal
+
+from sql.aggregate import Sum
+
+from trytond.pool import PoolMeta, Pool
 from trytond.model import fields, ModelView, Workflow
 from trytond.pyson import Eval
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice, reduce_ids
 
 __all__ = [
     'PaymentGateway', 'PaymentTransaction'
@@ -41,6 +47,11 @@ class PaymentTransaction:
             'readonly': Eval('state') != 'draft'
         }, select=True
     )
+    idempotency_key = fields.Char(
+        'Idempotency Key', readonly=True, select=True,
+        help='Key given by the client redeeming a gift card to identify '
+        'the retries of the same redemption'
+    )
 
     @classmethod
     def __setup__(cls):
@@ -51,6 +62,10 @@ class PaymentTransaction:
                 'Card %s is found to have insufficient amount',
             'negative_amount': 'The amount to be entered cannot be negative.',
         })
+        cls._sql_constraints += [
+            ('idempotency_key_uniq', 'UNIQUE(idempotency_key)',
+             'The idempotency key of the transaction must be unique.'),
+        ]
 
         cls._buttons['authorize']['invisible'] = \
             cls._buttons['authorize']['invisible'] & ~(
@@ -69,6 +84,149 @@ class PaymentTransaction:
                 (Eval('method') == 'gift_card')
         )
 
+    @classmethod
+    def get_gift_card_amounts(cls, column, ids):
+        """
+        Returns a dictionary of gift card id and a tuple of the amount
+        authorized and the amount captured by the gift card transactions
+        whose `column` is one of the given ids.
+
+        Gift cards without any authorized or captured transaction are not
+        part of the result.
+        """
+        GiftCard = Pool().get('gift_card.gift_card')
+        transaction = cls.__table__()
+        cursor = Transaction().cursor
+
+        amounts = {}
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*transaction.select(
+                transaction.gift_card, transaction.state,
+                Sum(transaction.amount),
+                where=reduce_ids(getattr(transaction, column), sub_ids) &
+                transaction.state.in_(['authorized', 'posted', 'done']),
+                group_by=[transaction.gift_card, transaction.state],
+            ))
+            for gift_card_id, state, amount in cursor.fetchall():
+                if gift_card_id is None:
+                    continue
+                amount = GiftCard._to_decimal(amount)
+                authorized, captured = amounts.get(
+                    gift_card_id, (Decimal('0'), Decimal('0'))
+                )
+                if state == 'authorized':
+                    authorized += amount
+                else:
+                    captured += amount
+                amounts[gift_card_id] = (authorized, captured)
+        return amounts
+
+    @classmethod
+    def _update_gift_card_balances(cls, before, after):
+        """
+        Update the balance ledger of gift cards with the difference between
+        the amounts of the transactions before and after a change
+        """
+        GiftCard = Pool().get('gift_card.gift_card')
+
+        zero = (Decimal('0'), Decimal('0'))
+        deltas = {}
+        for gift_card_id in set(before) | set(after):
+            old = before.get(gift_card_id, zero)
+            new = after.get(gift_card_id, zero)
+            deltas[gift_card_id] = (new[0] - old[0], new[1] - old[1])
+        GiftCard.update_balances(deltas)
+
+    @classmethod
+    def copy(cls, transactions, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default['idempotency_key'] = None
+        return super(PaymentTransaction, cls).copy(
+            transactions, default=default
+        )
+
+    def get_redemption(self):
+        """
+        Returns a dictionary describing the redemption of a gift card made
+        by this transaction
+        """
+        return {
+            'transaction': self.id,
+            'gift_card': self.gift_card.number,
+            'state': self.state,
+            'amount': self.amount,
+            'currency': self.currency.code,
+        }
+
+    @classmethod
+    def create(cls, vlist):
+        transactions = super(PaymentTransaction, cls).create(vlist)
+        cls._update_gift_card_balances(
+            {}, cls.get_gift_card_amounts('id', map(int, transactions))
+        )
+        return transactions
+
+    @classmethod
+    def write(cls, *args):
+        """
+        Keep the balance ledger of gift cards up to date.
+
+        Authorization, capture, settlement, posting and cancellation all end
+        up writing the state of the transaction, so the ledger is updated
+        with the amounts moved by the written transactions only.
+        """
+        actions = iter(args)
+        ids = []
+        for transactions, values in zip(actions, actions):
+            if set(values) & set(['state', 'amount', 'gift_card']):
+                ids.extend(map(int, transactions))
+
+        before = cls.get_gift_card_amounts('id', ids)
+        super(PaymentTransaction, cls).write(*args)
+        cls._update_gift_card_balances(
+            before, cls.get_gift_card_amounts('id', ids)
+        )
+
+    @classmethod
+    def delete(cls, transactions):
+        before = cls.get_gift_card_amounts('id', map(int, transactions))
+        super(PaymentTransaction, cls).delete(transactions)
+        cls._update_gift_card_balances(before, {})
+
+    @classmethod
+    def lock_gift_cards(cls, transactions):
+        """
+        Lock the gift cards used by the transactions before their amount
+        available is checked, so that two transactions can not redeem the
+        same amount concurrently.
+        """
+        GiftCard = Pool().get('gift_card.gift_card')
+
+        GiftCard.lock([t.gift_card for t in transactions if t.gift_card])
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('in-progress')
+    def authorize(cls, transactions):
+        cls.lock_gift_cards(transactions)
+        super(PaymentTransaction, cls).authorize(transactions)
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('in-progress')
+    def capture(cls, transactions):
+        cls.lock_gift_cards(transactions)
+        super(PaymentTransaction, cls).capture(transactions)
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('completed')
+    def settle(cls, transactions):
+        cls.lock_gift_cards(transactions)
+        super(PaymentTransaction, cls).settle(transactions)
+
     def validate_gift_card_amount(self, available_amount):
         """
         Validates that gift card has sufficient amount to pay
@@ -124,10 +282,35 @@ class PaymentTransaction:
         record, but ignore the error silently.
         """
         rv = super(PaymentTransaction, cls).post(transactions)
-
-        for transaction in transactions:
-            if transaction.gift_card and \
-                    transaction.gift_card.amount_available == 0:
-                transaction.gift_card.state = 'used'
-                transaction.gift_card.save()
+        cls.mark_gift_cards_used(transactions)
         return rv
+
+    @classmethod
+    def mark_gift_cards_used(cls, transactions):
+        """
+        Set to used state the active gift cards of the transactions which
+        have no amount available anymore.
+
+        The balances are read from the ledger of the gift cards in a query
+        per slice of gift cards, whatever the number of transactions made
+        with a same gift card, and the exhausted gift cards are written
+        together.
+        """
+        GiftCard = Pool().get('gift_card.gift_card')
+        gift_card = GiftCard.__table__()
+        cursor = Transaction().cursor
+
+        ids = set(t.gift_card.id for t in transactions if t.gift_card)
+
+        used_ids = []
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*gift_card.select(
+                gift_card.id,
+                where=reduce_ids(gift_card.id, sub_ids) &
+                (gift_card.state == 'active') &
+                (gift_card.amount_available == 0),
+            ))
+            used_ids.extend(x[0] for x in cursor.fetchall())
+
+        if used_ids:
+            GiftCard.write(GiftCard.browse(used_ids), {'state': 'used'})
@@ -5,25 +5,68 @@
     :copyright: (c) 2014-2015 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import csv
+import json
+import logging
+import time
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from StringIO import StringIO
+
 from num2words import num2words
+from sql import For, Literal
+from sql.aggregate import Count, Min, Sum
+from sql.conditionals import Coalesce
+from sql.functions import Extract, Now
 
+from trytond import backend
 from trytond.model import ModelSQL, ModelView, Workflow, fields
 from trytond.pyson import Eval, If
-from trytond.wizard import Wizard, Button, StateView, StateTransition
+from trytond.cache import Cache
+from trytond.wizard import Wizard, Button, StateView, StateTransition, \
+    StateAction
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 from trytond.report import Report
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
 from jinja2 import Environment, PackageLoader
 from nereid import render_email
 from trytond.config import config
 
+logger = logging.getLogger(__name__)
+
 
 __all__ = [
     'GiftCard', 'GiftCardReport', 'GiftCardRedeemStart', 'GiftCardRedeemDone',
-    'GiftCardRedeemWizard',
+    'GiftCardRedeemWizard', 'GiftCardReconcileDone',
+    'GiftCardReconcileWizard', 'GiftCardIssueStart', 'GiftCardIssueDone',
+    'GiftCardIssueWizard', 'GiftCardImportStart', 'GiftCardImportDone',
+    'GiftCardImportWizard', 'GiftCardLiability', 'GiftCardBalanceSnapshot',
 ]
 
 
+# Environment of the email templates shared by the whole process, so that the
+# templates are parsed and compiled once. It is created on first use and
+# reloads a template when its file is changed on disk.
+_email_environment = None
+
+
+def get_email_environment():
+    """
+    Returns the jinja2 environment of the gift card email templates
+    """
+    global _email_environment
+
+    if _email_environment is None:
+        _email_environment = Environment(
+            loader=PackageLoader('trytond.modules.gift_card', 'emails'),
+            auto_reload=True,
+        )
+    return _email_environment
+
+
 class GiftCard(Workflow, ModelSQL, ModelView):
     "Gift Card"
     __name__ = 'gift_card.gift_card'
@@ -57,31 +100,44 @@ class GiftCard(Workflow, ModelSQL, ModelView):
         }, depends=['state', 'currency_digits'], required=True
     )
 
-    amount_authorized = fields.Function(
-        fields.Numeric(
-            "Amount Authorized", digits=(16, Eval('currency_digits', 2)),
-            depends=['currency_digits']
-        ), 'get_amount'
+    amount_authorized = fields.Numeric(
+        "Amount Authorized", digits=(16, Eval('currency_digits', 2)),
+        readonly=True, depends=['currency_digits']
     )
-    amount_captured = fields.Function(
-        fields.Numeric(
-            "Amount Captured", digits=(16, Eval('currency_digits', 2)),
-            depends=['currency_digits']
-        ), 'get_amount'
+    amount_captured = fields.Numeric(
+        "Amount Captured", digits=(16, Eval('currency_digits', 2)),
+        readonly=True, depends=['currency_digits']
     )
 
-    amount_available = fields.Function(
-        fields.Numeric(
-            "Amount Available", digits=(16, Eval('currency_digits', 2)),
-            depends=['currency_digits']
-        ), 'get_amount'
+    amount_available = fields.Numeric(
+        "Amount Available", digits=(16, Eval('currency_digits', 2)),
+        readonly=True, select=True, depends=['currency_digits']
     )
     state = fields.Selection([
         ('draft', 'Draft'),
         ('active', 'Active'),
         ('canceled', 'Canceled'),
         ('used', 'Used'),
+        ('expired', 'Expired'),
     ], 'State', readonly=True, required=True)
+    expiry_date = fields.Date(
+        'Expiry Date', select=True, states={
+            'readonly': Eval('state') != 'draft'
+        }, depends=['state'],
+        help='Last day the gift card can be redeemed'
+    )
+    activation_date = fields.Date(
+        'Activation Date', readonly=True,
+        help='Day the gift card became a liability'
+    )
+    cancellation_date = fields.Date(
+        'Cancellation Date', readonly=True,
+        help='Day the active gift card was canceled'
+    )
+    breakage_move = fields.Many2One(
+        'account.move', 'Breakage Move', readonly=True,
+        help='Move posting the amount left on the gift card when it expired'
+    )
 
     sale_line = fields.Many2One('sale.line', "Sale Line", readonly=True)
 
@@ -105,8 +161,29 @@ class GiftCard(Workflow, ModelSQL, ModelView):
         }
     )
 
-    is_email_sent = fields.Boolean("Is Email Sent ?", readonly=True)
+    is_email_sent = fields.Boolean(
+        "Is Email Sent ?", readonly=True, select=True
+    )
     comment = fields.Text('Comment')
+    report_cache = fields.Binary('Gift Card Report', readonly=True)
+    report_format = fields.Char('Gift Card Report Format', readonly=True)
+    report_cache_key = fields.Char('Gift Card Report Key', readonly=True)
+
+    _email_receivers_cache = Cache(
+        'gift_card.gift_card.email_receivers', context=False
+    )
+    # The balances are cached for a few seconds only, so that a change in
+    # another process is seen without resetting the cache of all processes
+    _balance_cache = Cache(
+        'gift_card.gift_card.balance', size_limit=256, context=False
+    )
+    _balance_cache_timeout = 10
+
+    # Columns of the exports of gift cards with their balance
+    _export_columns = [
+        'number', 'state', 'currency', 'amount', 'amount_authorized',
+        'amount_captured', 'amount_available',
+    ]
 
     def get_sale(self, name):
         """
@@ -124,36 +201,718 @@ class GiftCard(Workflow, ModelSQL, ModelView):
         return Transaction().context.get('company') and \
             Company(Transaction().context.get('company')).currency.id or None
 
-    def get_amount(self, name):
+    @classmethod
+    def get_amount(cls, gift_cards, names):
+        """
+        Returns authorized, captured and available amount for the gift cards
+        computed from their payment transactions.
+
+        All the amounts are computed with a single query grouped by gift card
+        and transaction state, instead of searching the transactions of each
+        gift card for each field.
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        amounts = PaymentTransaction.get_gift_card_amounts(
+            'gift_card', [g.id for g in gift_cards]
+        )
+        zero = (Decimal('0'), Decimal('0'))
+
+        result = {}
+        if 'amount_authorized' in names:
+            result['amount_authorized'] = dict(
+                (g.id, amounts.get(g.id, zero)[0]) for g in gift_cards
+            )
+        if 'amount_captured' in names:
+            result['amount_captured'] = dict(
+                (g.id, amounts.get(g.id, zero)[1]) for g in gift_cards
+            )
+        if 'amount_available' in names:
+            result['amount_available'] = dict(
+                (g.id, g.amount - sum(amounts.get(g.id, zero)))
+                for g in gift_cards
+            )
+        return result
+
+    @staticmethod
+    def _to_decimal(value):
+        """
+        Returns the amount read by a SQL query as a Decimal, as SQLite uses
+        float for Numeric columns and SUM
+        """
+        if not isinstance(value, Decimal):
+            value = Decimal(str(value))
+        return value
+
+    @classmethod
+    def _forget_balances(cls, numbers):
+        """
+        Drop the balances of the gift cards with the given numbers from the
+        cache of this process
+        """
+        for number in numbers:
+            cls._balance_cache.set(number, None)
+
+    @classmethod
+    def _clear_balance_cache(cls, ids):
+        """
+        Clean the cached values of gift cards whose balance has been updated
+        with SQL queries
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.select(
+                table.number, where=reduce_ids(table.id, sub_ids)
+            ))
+            cls._forget_balances([x[0] for x in cursor.fetchall()])
+        Transaction().counter += 1
+        for cache in Transaction().cursor.cache.itervalues():
+            if cls.__name__ in cache:
+                for id_ in ids:
+                    cache[cls.__name__].pop(id_, None)
+
+    @classmethod
+    def update_balances(cls, deltas):
+        """
+        Increment the balance ledger of gift cards
+
+        :param deltas: Dictionary of gift card id and a tuple of the amount
+                       authorized and the amount captured to add to the
+                       ledger
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        ids = []
+        for gift_card_id, (authorized, captured) in deltas.iteritems():
+            if not (authorized or captured):
+                continue
+            cursor.execute(*table.update(
+                columns=[
+                    table.amount_authorized, table.amount_captured,
+                    table.amount_available,
+                ],
+                values=[
+                    table.amount_authorized + authorized,
+                    table.amount_captured + captured,
+                    table.amount_available - (authorized + captured),
+                ],
+                where=table.id == gift_card_id
+            ))
+            ids.append(gift_card_id)
+        cls._clear_balance_cache(ids)
+
+    @classmethod
+    def _set_balances(cls, amounts):
+        """
+        Overwrite the balance ledger of gift cards
+
+        :param amounts: Dictionary of gift card id and a tuple of the amount
+                        authorized and the amount captured
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        for gift_card_id, (authorized, captured) in amounts.iteritems():
+            cursor.execute(*table.update(
+                columns=[
+                    table.amount_authorized, table.amount_captured,
+                    table.amount_available,
+                ],
+                values=[
+                    authorized, captured,
+                    table.amount - (authorized + captured),
+                ],
+                where=table.id == gift_card_id
+            ))
+        cls._clear_balance_cache(amounts.keys())
+
+    @classmethod
+    def lock(cls, gift_cards):
+        """
+        Lock the rows of the gift cards until the end of the transaction so
+        that concurrent redemptions of the same gift card are serialized.
+
+        The rows are locked in the order of their ids to avoid deadlocks
+        between transactions locking several gift cards. On PostgreSQL a
+        concurrent update of a locked gift card makes the waiting transaction
+        fail with a serialization error, which is retried by the dispatcher.
+        SQLite serializes write transactions, so nothing is done.
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        ids = sorted(set(map(int, gift_cards)))
+        if not ids or backend.name() == 'sqlite':
+            return
+
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.select(
+                table.id,
+                where=reduce_ids(table.id, sub_ids),
+                order_by=table.id,
+                for_=For('UPDATE')
+            ))
+        cls._clear_balance_cache(ids)
+
+    @classmethod
+    def reconcile_balances(cls, gift_cards):
+        """
+        Recompute the balance ledger of the gift cards from their payment
+        transactions and correct the cards which have drifted.
+
+        Returns a list of tuples of the form:
+
+        (gift_card, field_name, ledger_amount, computed_amount)
+        """
+        names = ['amount_authorized', 'amount_captured', 'amount_available']
+        computed = cls.get_amount(gift_cards, names)
+
+        drifts = []
+        to_fix = {}
+        for gift_card in gift_cards:
+            for name in names:
+                ledger_amount = getattr(gift_card, name)
+                computed_amount = computed[name][gift_card.id]
+                if ledger_amount != computed_amount:
+                    drifts.append(
+                        (gift_card, name, ledger_amount, computed_amount)
+                    )
+                    to_fix[gift_card.id] = (
+                        computed['amount_authorized'][gift_card.id],
+                        computed['amount_captured'][gift_card.id],
+                    )
+        cls._set_balances(to_fix)
+        return drifts
+
+    @classmethod
+    def get_balance(cls, number):
+        """
+        Returns the balance of the gift card with the given number as a
+        dictionary with its state, the code of its currency and its amount
+        available, or None if there is no gift card with this number.
+
+        The balance is read from the balance ledger by a single query on the
+        unique number of the gift card, without instantiating it, so that it
+        can be called for every inquiry of points of sale and web shops.
+        The balances are cached for `_balance_cache_timeout` seconds, and
+        until a gift card or its balance changes in the same process.
+        """
+        ModelAccess = Pool().get('ir.model.access')
+        Currency = Pool().get('currency.currency')
+        table = cls.__table__()
+        currency = Currency.__table__()
+        cursor = Transaction().cursor
+
+        ModelAccess.check(cls.__name__, 'read')
+
+        cached = cls._balance_cache.get(number)
+        if cached is not None and cached[0] > time.time():
+            return cached[1].copy()
+
+        cursor.execute(*table.join(
+            currency, condition=table.currency == currency.id
+        ).select(
+            table.number, table.state, currency.code, table.amount_available,
+            where=table.number == number,
+        ))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        number, state, currency_code, amount_available = row
+        balance = {
+            'number': number,
+            'state': state,
+            'currency': currency_code,
+            'amount_available': cls._to_decimal(amount_available),
+        }
+        cls._balance_cache.set(
+            number, (time.time() + cls._balance_cache_timeout, balance)
+        )
+        return balance.copy()
+
+    @classmethod
+    def get_redemption_gateway(cls):
+        """
+        Returns the active payment gateway used to redeem gift cards or None
+        """
+        Gateway = Pool().get('payment_gateway.gateway')
+
+        gateways = Gateway.search([
+            ('method', '=', 'gift_card'),
+            ('active', '=', True),
+        ], limit=1)
+        return gateways[0] if gateways else None
+
+    @classmethod
+    def redeem(
+        cls, number, amount, party, idempotency_key=None, description=None,
+        currency=None, address=None
+    ):
+        """
+        Redeem `amount` from the gift card with the given number by
+        capturing a payment transaction for the party, in a single call
+        which needs no wizard session.
+
+        The first redemption made with an idempotency key is returned,
+        without redeeming the gift card again, to all the calls using the
+        same key, so that clients can safely retry a redemption which timed
+        out. The key is stored with a unique constraint on the transaction,
+        and reusing it for another gift card or amount is an error.
+
+        When given, the currency code must be the one of the gift card. The
+        first address of the party is used if no address id is given.
+
+        Returns a dictionary with the transaction id, the gift card number,
+        the state, the amount and the currency code of the transaction.
+        """
+        pool = Pool()
+        PaymentTransaction = pool.get('payment_gateway.transaction')
+        Party = pool.get('party.party')
+        Address = pool.get('party.address')
+        Date = pool.get('ir.date')
+
+        if idempotency_key:
+            transactions = PaymentTransaction.search([
+                ('idempotency_key', '=', idempotency_key),
+            ], limit=1)
+            if transactions:
+                transaction, = transactions
+                if transaction.gift_card.number != unicode(number) or \
+                        transaction.amount != Decimal(str(amount)):
+                    cls.raise_user_error(
+                        'idempotency_key_mismatch', idempotency_key
+                    )
+                return transaction.get_redemption()
+
+        gift_cards = cls.search([('number', '=', number)], limit=1)
+        if not gift_cards:
+            cls.raise_user_error('gift_card_not_found', number)
+        gift_card, = gift_cards
+        if gift_card.state != 'active':
+            cls.raise_user_error('gift_card_not_active', number)
+        if currency and currency != gift_card.currency.code:
+            cls.raise_user_error(
+                'currency_mismatch', (number, gift_card.currency.code)
+            )
+
+        gateway = cls.get_redemption_gateway()
+        if not gateway:
+            cls.raise_user_error('gateway_missing')
+
+        party = Party(party)
+        if address is None:
+            addresses = Address.search([
+                ('party', '=', party.id),
+            ], order=[('invoice', 'DESC')], limit=1)
+            if not addresses:
+                cls.raise_user_error('address_missing', party.rec_name)
+            address = addresses[0].id
+
+        transaction, = PaymentTransaction.create([{
+            'description': description,
+            'date': Date.today(),
+            'party': party.id,
+            'address': address,
+            'amount': amount,
+            'currency': gift_card.currency.id,
+            'gateway': gateway.id,
+            'gift_card': gift_card.id,
+            'credit_account': party.account_receivable.id,
+            'idempotency_key': idempotency_key,
+        }])
+        PaymentTransaction.capture([transaction])
+
+        return PaymentTransaction(transaction.id).get_redemption()
+
+    @classmethod
+    def _get_redemption_error(cls, number, gift_card, amount, available):
         """
-        Returns authorzied, captured and available amount for the gift card
+        Returns the error message preventing to redeem `amount` from the
+        gift card with the `available` amount, or None
         """
         PaymentTransaction = Pool().get('payment_gateway.transaction')
 
-        if name == 'amount_authorized':
-            return sum([t.amount for t in PaymentTransaction.search([
-                ('state', '=', 'authorized'),
-                ('gift_card', '=', self.id)
-            ])])
-
-        if name == 'amount_captured':
-            return sum([t.amount for t in PaymentTransaction.search([
-                ('state', 'in', ['posted', 'done']),
-                ('gift_card', '=', self.id)
-            ])])
-
-        if name == 'amount_available':
-            return self.amount - sum([
-                t.amount for t in PaymentTransaction.search([
-                    ('state', 'in', ['authorized', 'posted', 'done']),
-                    ('gift_card', '=', self.id)
+        if gift_card is None:
+            return cls.raise_user_error(
+                'gift_card_not_found', number, raise_exception=False
+            )
+        if gift_card.state != 'active':
+            return cls.raise_user_error(
+                'gift_card_not_active', number, raise_exception=False
+            )
+        if amount < 0:
+            return PaymentTransaction.raise_user_error(
+                'negative_amount', raise_exception=False
+            )
+        if available < amount:
+            return PaymentTransaction.raise_user_error(
+                'insufficient_amount', number, raise_exception=False
+            )
+
+    @classmethod
+    def redeem_batch(cls, entries, party, description=None):
+        """
+        Redeem many gift cards at once, like for the settlement files of a
+        partner network.
+
+        :param entries: List of tuples of gift card number and amount to
+                        redeem from the gift card
+        :param party: Id of the party for which the gift cards are redeemed
+
+        The gift cards are locked in the order of their ids, then all the
+        entries are validated against the amount available on their gift
+        card, taking into account the previous entries of the batch. The
+        transactions of the valid entries are created with a single create
+        and captured together, while invalid entries do not abort the
+        batch.
+
+        Returns a list with, for each entry, the same dictionary as
+        `redeem` or a dictionary with the gift card number, the amount and
+        the error which prevented the redemption.
+        """
+        pool = Pool()
+        PaymentTransaction = pool.get('payment_gateway.transaction')
+        Party = pool.get('party.party')
+        Address = pool.get('party.address')
+        Date = pool.get('ir.date')
+
+        gateway = cls.get_redemption_gateway()
+        if not gateway:
+            cls.raise_user_error('gateway_missing')
+
+        party = Party(party)
+        addresses = Address.search([
+            ('party', '=', party.id),
+        ], order=[('invoice', 'DESC')], limit=1)
+        if not addresses:
+            cls.raise_user_error('address_missing', party.rec_name)
+        address, = addresses
+
+        gift_card_ids = []
+        for numbers in grouped_slice(set(e[0] for e in entries)):
+            gift_card_ids.extend(map(int, cls.search([
+                ('number', 'in', list(numbers)),
+            ])))
+        cls.lock(gift_card_ids)
+        # Read the amounts available once the gift cards are locked
+        gift_cards = dict((g.number, g) for g in cls.browse(gift_card_ids))
+        available = dict(
+            (number, g.amount_available)
+            for number, g in gift_cards.iteritems()
+        )
+
+        today = Date.today()
+        results = []
+        vlist = []
+        indexes = []
+        for number, amount in entries:
+            gift_card = gift_cards.get(number)
+            error = cls._get_redemption_error(
+                number, gift_card, amount, available.get(number)
+            )
+            if error:
+                results.append({
+                    'gift_card': number,
+                    'amount': amount,
+                    'error': error,
+                })
+                continue
+
+            available[number] -= amount
+            indexes.append(len(results))
+            results.append(None)
+            vlist.append({
+                'description': description,
+                'date': today,
+                'party': party.id,
+                'address': address.id,
+                'amount': amount,
+                'currency': gift_card.currency.id,
+                'gateway': gateway.id,
+                'gift_card': gift_card.id,
+                'credit_account': party.account_receivable.id,
+            })
+
+        transactions = PaymentTransaction.create(vlist)
+        PaymentTransaction.capture(transactions)
+
+        transactions = PaymentTransaction.browse(map(int, transactions))
+        for index, transaction in zip(indexes, transactions):
+            results[index] = transaction.get_redemption()
+        return results
+
+    @staticmethod
+    def _read_csv(fileobj):
+        """
+        Yield the line number and a dictionary of values for each row of a
+        CSV file whose first line gives the names of the columns
+        """
+        reader = csv.DictReader(fileobj)
+        for row in reader:
+            yield reader.line_num, dict(
+                (k, v.decode('utf-8')) for k, v in row.iteritems()
+                if k and v is not None
+            )
+
+    @staticmethod
+    def _read_jsonl(fileobj):
+        """
+        Yield the line number and a dictionary of values for each line of a
+        JSON Lines file, or None if the line is not a JSON object
+        """
+        for line_num, line in enumerate(fileobj, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_num, row if isinstance(row, dict) else None
+
+    @classmethod
+    def import_file(
+        cls, fileobj, format_='csv', activate=False, chunk_size=1000,
+        commit=False
+    ):
+        """
+        Import gift cards from a CSV or JSON Lines file object.
+
+        Each row gives the number of the gift card, its opening balance as
+        amount and optionally the code of its currency, the name and the
+        email of its recipient. The file is read by chunks of `chunk_size`
+        rows, so it is never held in memory, and each chunk is created with
+        a single create keeping the numbers of the file.
+
+        Each chunk is committed when `commit` is set, so that the import of
+        a large file from a script does not run in a single transaction.
+        The progress is logged after each chunk.
+
+        Returns the number of gift cards imported and the list of rejected
+        rows as tuples of line number and error message.
+        """
+        reader = {
+            'csv': cls._read_csv,
+            'jsonl': cls._read_jsonl,
+        }[format_]
+        rows = reader(fileobj)
+
+        imported, rejected = 0, []
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            gift_cards, errors = cls.import_rows(chunk, activate=activate)
+            imported += len(gift_cards)
+            rejected.extend(errors)
+            if commit:
+                Transaction().cursor.commit()
+            logger.info(
+                'Gift card import up to line %d: %d imported, %d rejected',
+                chunk[-1][0], imported, len(rejected)
+            )
+        return imported, rejected
+
+    @classmethod
+    def import_rows(cls, rows, activate=False):
+        """
+        Create the gift cards of a chunk of imported rows.
+
+        :param rows: List of tuples of line number and dictionary of values
+        :param activate: Create the gift cards in active state
+
+        The imported gift cards are marked as emailed, so that they are not
+        sent again to their recipient.
+
+        Returns the gift cards created and the list of rejected rows as
+        tuples of line number and error message.
+        """
+        Currency = Pool().get('currency.currency')
+        Company = Pool().get('company.company')
+
+        company_id = Transaction().context.get('company')
+        default_currency = company_id and Company(company_id).currency
+
+        # JSON Lines rows may hold numbers where text is expected
+        rows = [
+            (line_num, row and dict(
+                (key, unicode(value) if value is not None and key in (
+                    'number', 'currency', 'recipient_name', 'recipient_email'
+                ) else value)
+                for key, value in row.iteritems()
+            )) for line_num, row in rows
+        ]
+
+        codes = set(
+            r.get('currency') for _, r in rows if r and r.get('currency')
+        )
+        currencies = dict(
+            (c.code, c) for c in Currency.search([('code', 'in', list(codes))])
+        )
+        numbers = [r.get('number') for _, r in rows if r and r.get('number')]
+        existing = set(
+            g.number for g in cls.search([('number', 'in', numbers)])
+        )
+
+        vlist, rejected = [], []
+        for line_num, row in rows:
+            if row is None:
+                rejected.append((line_num, cls.raise_user_error(
+                    'import_invalid_row', raise_exception=False
+                )))
+                continue
+            number = row.get('number')
+            if not number:
+                rejected.append((line_num, cls.raise_user_error(
+                    'import_missing_number', raise_exception=False
+                )))
+                continue
+            if number in existing:
+                rejected.append((line_num, cls.raise_user_error(
+                    'import_duplicate_number', number, raise_exception=False
+                )))
+                continue
+            try:
+                amount = Decimal(unicode(row.get('amount')))
+            except InvalidOperation:
+                amount = None
+            if amount is None or not amount.is_finite() or amount < 0:
+                rejected.append((line_num, cls.raise_user_error(
+                    'import_invalid_amount', unicode(row.get('amount')),
+                    raise_exception=False
+                )))
+                continue
+            currency = row.get('currency')
+            if currency:
+                currency = currencies.get(currency)
+            else:
+                currency = default_currency
+            if not currency:
+                rejected.append((line_num, cls.raise_user_error(
+                    'import_unknown_currency', row.get('currency'),
+                    raise_exception=False
+                )))
+                continue
+
+            existing.add(number)
+            vlist.append({
+                'number': number,
+                'amount': amount,
+                'currency': currency.id,
+                'recipient_name': row.get('recipient_name'),
+                'recipient_email': row.get('recipient_email'),
+                'state': 'active' if activate else 'draft',
+                'is_email_sent': True,
+            })
+        return cls.create(vlist), rejected
+
+    @classmethod
+    def iter_balances(cls, after=0, limit=None, chunk_size=1000):
+        """
+        Yield the id and a dictionary with the number, state, currency code,
+        amount and balance ledger of every gift card whose id is greater than
+        `after`, in the order of their ids, at most `limit` of them.
+
+        The gift cards are read by chunks of `chunk_size` rows with a query
+        starting after the last id read, so that the memory used does not
+        depend on the number of gift cards.
+        """
+        ModelAccess = Pool().get('ir.model.access')
+        Currency = Pool().get('currency.currency')
+        table = cls.__table__()
+        currency = Currency.__table__()
+        cursor = Transaction().cursor
+
+        ModelAccess.check(cls.__name__, 'read')
+
+        names = cls._export_columns
+        count = 0
+        while limit is None or count < limit:
+            size = chunk_size
+            if limit is not None:
+                size = min(size, limit - count)
+            cursor.execute(*table.join(
+                currency, condition=table.currency == currency.id
+            ).select(
+                table.id, table.number, table.state, currency.code,
+                table.amount, table.amount_authorized, table.amount_captured,
+                table.amount_available,
+                where=table.id > after,
+                order_by=table.id.asc,
+                limit=size,
+            ))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                values = dict(zip(names, row[1:]))
+                for name in names[3:]:
+                    values[name] = cls._to_decimal(values[name])
+                yield row[0], values
+            after = rows[-1][0]
+            count += len(rows)
+
+    @classmethod
+    def export_file(
+        cls, fileobj, format_='csv', after=0, limit=None, header=True
+    ):
+        """
+        Write the gift cards with their balance to a file object as CSV or
+        JSON Lines, row by row as they are read.
+
+        Returns the id of the last gift card written.
+        """
+        names = cls._export_columns
+        if format_ == 'csv':
+            writer = csv.writer(fileobj)
+            if header:
+                writer.writerow(names)
+
+            def write(values):
+                writer.writerow([
+                    unicode(values[n]).encode('utf-8') for n in names
                 ])
-            ])
+        else:
+            def write(values):
+                fileobj.write(json.dumps(dict(
+                    (n, unicode(values[n])) for n in names
+                )) + '\n')
+
+        last_id = after
+        for last_id, values in cls.iter_balances(after=after, limit=limit):
+            write(values)
+        return last_id
+
+    @classmethod
+    def export_balances(cls, format_='csv', after=0, limit=10000):
+        """
+        Returns a page of at most `limit` gift cards with their balance, as
+        CSV or JSON Lines, starting after the gift card id `after`, and the
+        id of the last gift card of the page.
+
+        Clients export all the gift cards by calling it again with the last
+        id returned until it returns no data, writing each page as it comes.
+        """
+        output = StringIO()
+        last_id = cls.export_file(
+            output, format_, after=after, limit=limit, header=not after
+        )
+        return output.getvalue(), last_id
 
     @staticmethod
     def default_state():
         return 'draft'
 
+    @staticmethod
+    def default_amount_authorized():
+        return Decimal('0')
+
+    @staticmethod
+    def default_amount_captured():
+        return Decimal('0')
+
     @fields.depends('currency')
     def on_change_with_currency_digits(self, name=None):
         if self.currency:
@@ -169,13 +928,47 @@ class GiftCard(Workflow, ModelSQL, ModelView):
         ]
         cls._error_messages.update({
             'deletion_not_allowed':
-                "Gift cards can not be deleted in active state"
+                "Gift cards can not be deleted in active state",
+            'gift_card_not_found': 'There is no gift card numbered "%s".',
+            'balance_not_writable':
+                'The amounts authorized, captured and available of gift '
+                'cards can only be changed by their payment transactions.',
+            'gift_card_not_active':
+                'The gift card "%s" to be redeemed must be in active state.',
+            'gateway_missing':
+                'There is no active payment gateway for gift cards.',
+            'address_missing': 'The party "%s" has no address.',
+            'currency_mismatch':
+                'The gift card "%s" can only be redeemed in %s.',
+            'idempotency_key_mismatch':
+                'The idempotency key "%s" is already used by the redemption '
+                'of another gift card or amount.',
+            'import_invalid_row': 'The row is not a valid gift card.',
+            'import_missing_number': 'The number of the gift card is missing.',
+            'import_invalid_amount':
+                'The amount "%s" of the gift card is not valid.',
+            'import_unknown_currency': 'The currency "%s" is unknown.',
+            'import_duplicate_number':
+                'A gift card numbered "%s" already exists.',
+            'liability_account_missing':
+                'A liability account is required to expire gift cards.',
+            'breakage_account_missing':
+                'A breakage account is required to expire gift cards.',
+            'breakage_journal_missing':
+                'A breakage journal is required to expire gift cards.',
+        })
+        cls.__rpc__.update({
+            'get_balance': RPC(),
+            'redeem': RPC(readonly=False),
+            'redeem_batch': RPC(readonly=False),
+            'export_balances': RPC(),
         })
         cls._transitions |= set((
             ('draft', 'active'),
             ('active', 'canceled'),
             ('draft', 'canceled'),
             ('canceled', 'draft'),
+            ('active', 'expired'),
         ))
         cls._buttons.update({
             'cancel': {
@@ -194,18 +987,185 @@ class GiftCard(Workflow, ModelSQL, ModelView):
         })
 
     @classmethod
-    def create(cls, vlist):
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        migrate_balances = migrate_activation = False
+        if TableHandler.table_exist(cursor, cls._table):
+            table_h = TableHandler(cursor, cls, module_name)
+            migrate_balances = not table_h.column_exist('amount_available')
+            migrate_activation = not table_h.column_exist('activation_date')
+
+        super(GiftCard, cls).__register__(module_name)
+
+        # Migration from 3.4.1.4: the gift cards issued are activated on the
+        # day they are created
+        if migrate_activation:
+            cursor.execute(*table.select(
+                table.id, table.create_date,
+                where=table.state.in_(['active', 'used', 'expired'])
+            ))
+            ids_by_date = {}
+            for id_, create_date in cursor.fetchall():
+                ids_by_date.setdefault(create_date.date(), []).append(id_)
+            for activation_date, ids in ids_by_date.iteritems():
+                for sub_ids in grouped_slice(ids):
+                    cursor.execute(*table.update(
+                        columns=[table.activation_date],
+                        values=[activation_date],
+                        where=reduce_ids(table.id, sub_ids)
+                    ))
+
+        # Migration from 3.4.1.4: amounts are stored in a balance ledger
+        if migrate_balances:
+            PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+            cursor.execute(*table.select(table.id))
+            ids = [x[0] for x in cursor.fetchall()]
+            amounts = PaymentTransaction.get_gift_card_amounts(
+                'gift_card', ids
+            )
+            zero = (Decimal('0'), Decimal('0'))
+            cls._set_balances(
+                dict((id_, amounts.get(id_, zero)) for id_ in ids)
+            )
+
+    @classmethod
+    def get_numbers(cls, count):
+        """
+        Returns a list of `count` numbers reserved from the gift card number
+        sequence in a single sequence operation.
+
+        Only incremental sequences can be reserved by block, numbers of the
+        timestamp sequences are fetched one by one.
+        """
         Sequence = Pool().get('ir.sequence')
         Configuration = Pool().get('gift_card.configuration')
+        cursor = Transaction().cursor
+
+        if not count:
+            return []
+
+        # bypass rules on sequences like ir.sequence does
+        with Transaction().set_context(user=False, _check_access=False):
+            with Transaction().set_user(0):
+                sequence = Sequence(Configuration(1).number_sequence.id)
+
+                if sequence.type != 'incremental':
+                    return [
+                        Sequence.get_id(sequence.id) for _ in xrange(count)
+                    ]
+
+                if backend.name() == 'postgresql':
+                    cursor.execute(
+                        'SELECT nextval(\'"%s"\') FROM generate_series(1, %%s)'
+                        % sequence._sql_sequence_name, (count,)
+                    )
+                    numbers = [x[0] for x in cursor.fetchall()]
+                else:
+                    number_next = sequence.number_next_internal
+                    Sequence.write([sequence], {
+                        'number_next_internal': (
+                            number_next + count * sequence.number_increment
+                        ),
+                    })
+                    numbers = [
+                        number_next + i * sequence.number_increment
+                        for i in xrange(count)
+                    ]
+
+                date = Transaction().context.get('date')
+                prefix = Sequence._process(sequence.prefix, date=date)
+                suffix = Sequence._process(sequence.suffix, date=date)
+                return [
+                    '%s%s%s' % (
+                        prefix, '%%0%sd' % sequence.padding % number, suffix
+                    ) for number in numbers
+                ]
+
+    @classmethod
+    def create(cls, vlist):
+        Date = Pool().get('ir.date')
 
         vlist = [x.copy() for x in vlist]
+        numbers = iter(cls.get_numbers(
+            len([v for v in vlist if not v.get('number')])
+        ))
+        today = Date.today()
         for values in vlist:
             if not values.get('number'):
-                values['number'] = Sequence.get_id(
-                    Configuration(1).number_sequence.id
-                )
+                values['number'] = numbers.next()
+            if values.get('state') == 'active':
+                values.setdefault('activation_date', today)
+            # A new gift card does not have any transaction yet
+            values['amount_authorized'] = Decimal('0')
+            values['amount_captured'] = Decimal('0')
+            values['amount_available'] = values.get('amount')
         return super(GiftCard, cls).create(vlist)
 
+    @classmethod
+    def write(cls, *args):
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        actions = iter(args)
+        args = []
+        ids = []
+        for gift_cards, values in zip(actions, actions):
+            # The balance ledger is only maintained by the transactions
+            if set(values) & set([
+                    'amount_authorized', 'amount_captured', 'amount_available'
+            ]):
+                cls.raise_user_error('balance_not_writable')
+            if 'amount' in values:
+                ids.extend(map(int, gift_cards))
+            if set(values) & set(['number', 'state', 'currency', 'amount']):
+                cls._forget_balances([g.number for g in gift_cards])
+            # The printed gift card is outdated if anything else than its
+            # state is changed
+            if set(values) - set([
+                    'state', 'is_email_sent', 'report_cache', 'report_format',
+                    'report_cache_key', 'activation_date', 'cancellation_date',
+            ]):
+                values = values.copy()
+                values['report_cache'] = None
+                values['report_format'] = None
+                values['report_cache_key'] = None
+            args.extend((gift_cards, values))
+
+        super(GiftCard, cls).write(*args)
+
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.update(
+                columns=[table.amount_available],
+                values=[
+                    table.amount -
+                    (table.amount_authorized + table.amount_captured)
+                ],
+                where=reduce_ids(table.id, sub_ids)
+            ))
+        cls._clear_balance_cache(ids)
+
+    @classmethod
+    def issue(cls, quantity, values, chunk_size=1000):
+        """
+        Create `quantity` gift cards with the given values, like for the
+        physical cards of a corporate order.
+
+        The cards are created by chunks of `chunk_size` so that the numbers
+        of each chunk are reserved in one sequence operation.
+
+        Returns the list of gift cards created
+        """
+        gift_cards = []
+        for start in xrange(0, quantity, chunk_size):
+            gift_cards.extend(cls.create([
+                values for _ in xrange(min(chunk_size, quantity - start))
+            ]))
+        return gift_cards
+
     @classmethod
     def copy(cls, gift_cards, default=None):
         if default is None:
@@ -215,6 +1175,12 @@ class GiftCard(Workflow, ModelSQL, ModelView):
         default['sale_line'] = None
         default['state'] = cls.default_state()
         default['payment_transactions'] = None
+        default['report_cache'] = None
+        default['report_format'] = None
+        default['report_cache_key'] = None
+        default['activation_date'] = None
+        default['cancellation_date'] = None
+        default['breakage_move'] = None
         return super(GiftCard, cls).copy(gift_cards, default=default)
 
     @classmethod
@@ -223,10 +1189,17 @@ class GiftCard(Workflow, ModelSQL, ModelView):
     def activate(cls, gift_cards):
         """
         Set gift cards to active state
+
+        Active gift cards with a recipient email are sent later by the
+        `send_pending_emails` cron, so that activating many gift cards does
+        not wait for their reports to be rendered.
         """
-        for gift_card in gift_cards:
-            if gift_card.recipient_email and not gift_card.is_email_sent:
-                gift_card.send_gift_card_as_email()
+        Date = Pool().get('ir.date')
+
+        cls.write(gift_cards, {
+            'activation_date': Date.today(),
+            'cancellation_date': None,
+        })
 
     @classmethod
     @ModelView.button
@@ -235,7 +1208,10 @@ class GiftCard(Workflow, ModelSQL, ModelView):
         """
         Set gift cards back to draft state
         """
-        pass
+        cls.write(gift_cards, {
+            'activation_date': None,
+            'cancellation_date': None,
+        })
 
     @classmethod
     @ModelView.button
@@ -243,8 +1219,170 @@ class GiftCard(Workflow, ModelSQL, ModelView):
     def cancel(cls, gift_cards):
         """
         Cancel gift cards
+
+        The cancellation of the active gift cards is dated as it ends their
+        liability.
+        """
+        Date = Pool().get('ir.date')
+
+        active_gift_cards = [g for g in gift_cards if g.state == 'active']
+        if active_gift_cards:
+            cls.write(active_gift_cards, {'cancellation_date': Date.today()})
+
+    @classmethod
+    @Workflow.transition('expired')
+    def expire(cls, gift_cards, date_=None):
+        """
+        Expire gift cards and post the amount left on them as breakage at the
+        given date, today by default, with one move per currency
+        """
+        Move = Pool().get('account.move')
+        Date = Pool().get('ir.date')
+
+        if date_ is None:
+            date_ = Date.today()
+
+        # Read the amounts left once no redemption can change them
+        cls.lock(gift_cards)
+        gift_cards_by_currency = {}
+        for gift_card in cls.browse(map(int, gift_cards)):
+            if gift_card.amount_available:
+                gift_cards_by_currency.setdefault(
+                    gift_card.currency, []
+                ).append(gift_card)
+
+        currency_gift_cards = gift_cards_by_currency.values()
+        moves = Move.create([
+            cls._get_breakage_move(cards, date_)
+            for cards in currency_gift_cards
+        ])
+        Move.post(moves)
+
+        args = []
+        for cards, move in zip(currency_gift_cards, moves):
+            args.extend((cards, {'breakage_move': move.id}))
+        if args:
+            cls.write(*args)
+
+    @classmethod
+    def _get_breakage_move(cls, gift_cards, date_):
+        """
+        Returns the values of the move which posts as breakage the amount
+        left on gift cards of the same currency, debiting the liability
+        account by gift card
+        """
+        pool = Pool()
+        Configuration = pool.get('gift_card.configuration')
+        Company = pool.get('company.company')
+        Currency = pool.get('currency.currency')
+        Period = pool.get('account.period')
+
+        configuration = Configuration(1)
+        if not configuration.liability_account:
+            cls.raise_user_error('liability_account_missing')
+        if not configuration.breakage_account:
+            cls.raise_user_error('breakage_account_missing')
+        if not configuration.breakage_journal:
+            cls.raise_user_error('breakage_journal_missing')
+
+        company = Company(Transaction().context['company'])
+        currency = gift_cards[0].currency
+        second_currency = currency != company.currency
+
+        lines = []
+        total = total_second_currency = Decimal('0')
+        for gift_card in gift_cards:
+            with Transaction().set_context(date=date_):
+                amount = Currency.compute(
+                    currency, gift_card.amount_available, company.currency
+                )
+            line = {
+                'account': configuration.liability_account.id,
+                'debit': amount,
+                'credit': Decimal('0'),
+                'description': gift_card.number,
+            }
+            if second_currency:
+                line['amount_second_currency'] = gift_card.amount_available
+                line['second_currency'] = currency.id
+            lines.append(line)
+            total += amount
+            total_second_currency += gift_card.amount_available
+
+        line = {
+            'account': configuration.breakage_account.id,
+            'debit': Decimal('0'),
+            'credit': total,
+        }
+        if second_currency:
+            line['amount_second_currency'] = -total_second_currency
+            line['second_currency'] = currency.id
+        lines.append(line)
+
+        return {
+            'journal': configuration.breakage_journal.id,
+            'period': Period.find(company.id, date=date_),
+            'date': date_,
+            'description': 'Gift Card Breakage',
+            'lines': [('create', lines)],
+        }
+
+    @staticmethod
+    def get_default_company():
+        """
+        Returns the id of the company of the gift cards not sold, which
+        carry no company of their own: the first company
+        """
+        Company = Pool().get('company.company')
+
+        companies = Company.search([], order=[('id', 'ASC')], limit=1)
+        return companies[0].id if companies else None
+
+    @classmethod
+    def expire_gift_cards(cls, date_=None, chunk_size=1000, commit=True):
+        """
+        Expire the active gift cards whose expiry date is passed at the
+        given date, today by default, by chunks of `chunk_size` found on
+        the index of the expiry date.
+
+        Each chunk is committed when `commit` is set, so that a sweep of
+        many gift cards only locks the gift cards of one chunk at a time.
+        The gift cards are expired in the company of their sale, the ones
+        not sold in the default company.
+
+        This method is intended to be called by a cron.
         """
-        pass
+        Company = Pool().get('company.company')
+        Date = Pool().get('ir.date')
+
+        if date_ is None:
+            date_ = Date.today()
+
+        default_company = cls.get_default_company()
+        for company in Company.search([], order=[('id', 'ASC')]):
+            domain = [
+                ('state', '=', 'active'),
+                ('expiry_date', '<', date_),
+            ]
+            if company.id == default_company:
+                domain.append([
+                    'OR',
+                    ('sale_line', '=', None),
+                    ('sale_line.sale.company', '=', company.id),
+                ])
+            else:
+                domain.append(('sale_line.sale.company', '=', company.id))
+
+            with Transaction().set_context(company=company.id):
+                while True:
+                    gift_cards = cls.search(
+                        domain, order=[('id', 'ASC')], limit=chunk_size
+                    )
+                    if not gift_cards:
+                        break
+                    cls.expire(gift_cards, date_)
+                    if commit:
+                        Transaction().cursor.commit()
 
     @classmethod
     def get_origin(cls):
@@ -263,6 +1401,7 @@ class GiftCard(Workflow, ModelSQL, ModelView):
             if gift_card.state == 'active':
                 cls.raise_user_error("deletion_not_allowed")
 
+        cls._forget_balances([g.number for g in gift_cards])
         return super(GiftCard, cls).delete(gift_cards)
 
     def _get_subject_for_email(self):
@@ -277,52 +1416,37 @@ class GiftCard(Workflow, ModelSQL, ModelView):
 
         (html_template, text_template)
         """
-        env = Environment(loader=PackageLoader(
-            'trytond.modules.gift_card', 'emails'
-        ))
+        env = get_email_environment()
         return (
             env.get_template('gift_card_html.html'),
             env.get_template('gift_card_text.html')
         )
 
-    def send_gift_card_as_email(self):
+    def _get_email(self, sender):
         """
-        Send gift card as an attachment in the email
+        Returns the email with the gift card attached, or None if the gift
+        card report could not be generated
         """
-        EmailQueue = Pool().get('email.queue')
         GiftCardReport = Pool().get('gift_card.gift_card', type='report')
-        ModelData = Pool().get('ir.model.data')
-        Group = Pool().get('res.group')
-
-        group_id = ModelData.get_id(
-            "gift_card", "gift_card_email_receivers"
-        )
-        bcc_emails = map(
-            lambda user: user.email,
-            filter(lambda user: user.email, Group(group_id).users)
-        )
-
-        if not self.recipient_email:  # pragma: no cover
-            return
 
         # Try to generate report twice
         # This is needed as sometimes `unoconv` fails to convert report to pdf
         for try_count in range(2):
             try:
-                val = GiftCardReport.execute([self.id], {})
+                # The report emailed is not printed again
+                with Transaction().set_context(gift_card_report_cache=False):
+                    val = GiftCardReport.execute([self.id], {})
                 break
             except:  # pragma: no cover
                 if try_count == 0:
                     continue
                 else:
-                    return
+                    return None
 
         subject = self._get_subject_for_email()
         html_template, text_template = self._get_email_templates()
 
-        sender = config.get('email', 'from')
-
-        email_gift_card = render_email(
+        return render_email(
             sender, self.recipient_email,
             subject,
             html_template=html_template,
@@ -331,30 +1455,150 @@ class GiftCard(Workflow, ModelSQL, ModelView):
             card=self,
         )
 
-        EmailQueue.queue_mail(
-            sender, [self.recipient_email] + bcc_emails,
-            email_gift_card.as_string()
-        )
-        self.is_email_sent = True
-        self.save()
+    @classmethod
+    def send_gift_cards_as_email(cls, gift_cards):
+        """
+        Send the gift cards as an attachment in the email to their recipient
+
+        The emails of all the gift cards are queued together and the gift
+        cards are marked as sent with a single write.
+        """
+        EmailQueue = Pool().get('email.queue')
+
+        bcc_emails = cls.get_email_receivers()
+
+        sender = config.get('email', 'from')
+
+        emails = []
+        sent = []
+        for gift_card in gift_cards:
+            if not gift_card.recipient_email:  # pragma: no cover
+                continue
+
+            email_gift_card = gift_card._get_email(sender)
+            if email_gift_card is None:  # pragma: no cover
+                continue
+
+            emails.append({
+                'from_addr': sender,
+                'to_addrs': ','.join([gift_card.recipient_email] + bcc_emails),
+                'msg': email_gift_card.as_string(),
+            })
+            sent.append(gift_card)
+
+        if emails:
+            EmailQueue.create(emails)
+            cls.write(sent, {'is_email_sent': True})
+
+    @classmethod
+    def get_email_receivers(cls):
+        """
+        Returns the emails of the users of the group which receives a copy
+        of all the gift card emails.
+
+        The emails are cached until a user or a group is changed.
+        """
+        ModelData = Pool().get('ir.model.data')
+        Group = Pool().get('res.group')
+
+        emails = cls._email_receivers_cache.get(None)
+        if emails is not None:
+            return list(emails)
+
+        group_id = ModelData.get_id(
+            "gift_card", "gift_card_email_receivers"
+        )
+        emails = map(
+            lambda user: user.email,
+            filter(lambda user: user.email, Group(group_id).users)
+        )
+        cls._email_receivers_cache.set(None, emails)
+        return list(emails)
+
+    def send_gift_card_as_email(self):
+        """
+        Send gift card as an attachment in the email
+        """
+        self.send_gift_cards_as_email([self])
+
+    @classmethod
+    def send_pending_emails(cls, batch_size=100):
+        """
+        Send the active gift cards which have not been emailed to their
+        recipient yet, by batches of `batch_size`.
+
+        This method is intended to be called by a cron.
+        """
+        gift_cards = cls.search([
+            ('state', '=', 'active'),
+            ('recipient_email', '!=', None),
+            ('is_email_sent', '=', False),
+        ], order=[('id', 'ASC')])
+
+        for start in xrange(0, len(gift_cards), batch_size):
+            cls.send_gift_cards_as_email(
+                gift_cards[start:start + batch_size]
+            )
 
 
 class GiftCardReport(Report):
     __name__ = 'gift_card.gift_card'
 
+    @classmethod
+    def __setup__(cls):
+        super(GiftCardReport, cls).__setup__()
+        # The report of the gift card is saved on it when printed
+        cls.__rpc__['execute'] = RPC(False)
+
+    @classmethod
+    def get_cache_key(cls):
+        """
+        Returns the key of the saved reports which can be reprinted.
+
+        The report shows the date it is printed in the language of the user,
+        so a saved report is only valid for the same language and day.
+        """
+        User = Pool().get('res.user')
+        Date = Pool().get('ir.date')
+
+        user = User(Transaction().user)
+        language = user.language.code if user.language else ''
+        return '%s,%s' % (language, Date.today())
+
     @classmethod
     def parse(cls, report, records, data, localcontext):
         """
         Update localcontext to add num2words
+
+        The report of a single gift card which is no more in draft is saved
+        on the gift card, so that reprints of the same day in the same
+        language do not render and convert it again until the gift card is
+        changed. The reports rendered to be emailed are not saved.
         """
+        GiftCard = Pool().get('gift_card.gift_card')
+
+        cache_key = cls.get_cache_key()
+        if len(records) == 1 and records[0].report_cache and \
+                records[0].report_cache_key == cache_key:
+            return (records[0].report_format, records[0].report_cache)
+
         localcontext.update({
             'num2words': lambda *args, **kargs: num2words(
                 *args, **kargs)
         })
-        return super(GiftCardReport, cls).parse(
+        res = super(GiftCardReport, cls).parse(
             report, records, data, localcontext
         )
 
+        if len(records) == 1 and records[0].state != 'draft' and \
+                Transaction().context.get('gift_card_report_cache', True):
+            GiftCard.write([GiftCard(records[0].id)], {
+                'report_format': res[0],
+                'report_cache': buffer(res[1]),
+                'report_cache_key': cache_key,
+            })
+        return res
+
 
 class GiftCardRedeemStart(ModelView):
     "Gift Card Redeem Start View"
@@ -476,7 +1720,6 @@ class GiftCardRedeemWizard(Wizard):
         """
         Initial state of redeem wizard.
         """
-        Gateway = Pool().get('payment_gateway.gateway')
         GiftCard = Pool().get('gift_card.gift_card')
 
         try:
@@ -491,15 +1734,9 @@ class GiftCardRedeemWizard(Wizard):
         res = {
             'gift_card': gift_card.id,
         }
-        try:
-            gateway, = Gateway.search([
-                ('method', '=', 'gift_card'),
-                ('active', '=', True),
-            ])
-        except ValueError:
-            return res
-
-        res.update({'gateway': gateway.id})
+        gateway = GiftCard.get_redemption_gateway()
+        if gateway:
+            res['gateway'] = gateway.id
         return res
 
     def transition_redeem(self):
@@ -547,3 +1784,592 @@ class GiftCardRedeemWizard(Wizard):
             self.raise_user_error('gift_card_redeemed')
         elif gift_card.state != 'active':
             self.raise_user_error('gift_card_inactive')
+
+
+class GiftCardReconcileDone(ModelView):
+    "Gift Card Reconcile Done View"
+    __name__ = 'gift_card.reconcile.end'
+
+    report = fields.Text('Drift Report', readonly=True)
+
+
+class GiftCardReconcileWizard(Wizard):
+    "Gift Card Reconcile Wizard"
+    __name__ = 'gift_card.reconcile.wizard'
+
+    start_state = 'reconcile'
+    reconcile = StateTransition()
+    done = StateView(
+        'gift_card.reconcile.end',
+        'gift_card.reconcile_done_view_form',
+        [
+            Button('OK', 'end', 'tryton-ok')
+        ]
+    )
+
+    def transition_reconcile(self):
+        """
+        Recompute the balance ledger of the selected gift cards, or of all
+        gift cards if none is selected, and report the drifts corrected.
+        """
+        GiftCard = Pool().get('gift_card.gift_card')
+
+        active_ids = Transaction().context.get('active_ids')
+        if active_ids:
+            gift_cards = GiftCard.browse(active_ids)
+        else:
+            gift_cards = GiftCard.search([])
+
+        drifts = GiftCard.reconcile_balances(gift_cards)
+
+        if not drifts:
+            self.done.report = (
+                'No drift found in the balance of %d gift cards.'
+                % len(gift_cards)
+            )
+            return 'done'
+
+        lines = [
+            '%d drifts corrected in the balance of %d gift cards:'
+            % (len(drifts), len(gift_cards))
+        ]
+        for gift_card, name, ledger_amount, computed_amount in drifts:
+            lines.append('%s: %s was %s, recomputed to %s' % (
+                gift_card.number, GiftCard._fields[name].string,
+                ledger_amount, computed_amount
+            ))
+        self.done.report = '\n'.join(lines)
+        return 'done'
+
+    def default_done(self, data):
+        """
+        Returns the report of the reconciliation.
+        """
+        return {
+            'report': self.done.report,
+        }
+
+
+class GiftCardIssueStart(ModelView):
+    "Gift Card Issue Start View"
+    __name__ = 'gift_card.issue.start'
+
+    quantity = fields.Integer('Quantity', required=True)
+    amount = fields.Numeric(
+        'Amount', digits=(16, Eval('currency_digits', 2)), required=True,
+        depends=['currency_digits']
+    )
+    currency = fields.Many2One('currency.currency', 'Currency', required=True)
+    currency_digits = fields.Function(
+        fields.Integer('Currency Digits'),
+        'on_change_with_currency_digits'
+    )
+    activate = fields.Boolean('Activate')
+    comment = fields.Text('Comment')
+
+    @staticmethod
+    def default_currency():
+        """
+        Set currency of current company as default currency
+        """
+        Company = Pool().get('company.company')
+
+        return Transaction().context.get('company') and \
+            Company(Transaction().context.get('company')).currency.id or None
+
+    @fields.depends('currency')
+    def on_change_with_currency_digits(self, name=None):
+        if self.currency:
+            return self.currency.digits
+        return 2
+
+
+class GiftCardIssueDone(ModelView):
+    "Gift Card Issue Done View"
+    __name__ = 'gift_card.issue.end'
+
+    done_msg = fields.Text('Issuance Complete', readonly=True)
+    gift_cards = fields.Many2Many(
+        'gift_card.gift_card', None, None, 'Gift Cards', readonly=True
+    )
+
+
+class GiftCardIssueWizard(Wizard):
+    "Gift Card Issue Wizard"
+    __name__ = 'gift_card.issue.wizard'
+
+    start = StateView(
+        'gift_card.issue.start',
+        'gift_card.issue_start_view_form',
+        [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Issue', 'issue', 'tryton-ok', default=True)
+        ]
+    )
+    issue = StateTransition()
+    done = StateView(
+        'gift_card.issue.end',
+        'gift_card.issue_done_view_form',
+        [
+            Button('Print', 'print_', 'tryton-print'),
+            Button('OK', 'end', 'tryton-ok', default=True)
+        ]
+    )
+    print_ = StateAction('gift_card.report_gift_card')
+
+    @classmethod
+    def __setup__(cls):
+        super(GiftCardIssueWizard, cls).__setup__()
+        cls._error_messages.update({
+            'invalid_quantity': (
+                'The quantity of gift cards to issue must be positive.'
+            ),
+        })
+
+    def transition_issue(self):
+        """
+        Issue the gift cards in bulk
+        """
+        GiftCard = Pool().get('gift_card.gift_card')
+
+        if self.start.quantity <= 0:
+            self.raise_user_error('invalid_quantity')
+
+        gift_cards = GiftCard.issue(self.start.quantity, {
+            'amount': self.start.amount,
+            'currency': self.start.currency.id,
+            'comment': self.start.comment,
+        })
+        if self.start.activate:
+            GiftCard.activate(gift_cards)
+
+        self.done.done_msg = '%d gift cards issued, numbered %s to %s.' % (
+            len(gift_cards), gift_cards[0].number, gift_cards[-1].number
+        )
+        self.done.gift_cards = gift_cards
+        return 'done'
+
+    def default_done(self, data):
+        """
+        Returns a message with the numbers of the gift cards issued.
+        """
+        return {
+            'done_msg': self.done.done_msg,
+            'gift_cards': map(int, self.done.gift_cards),
+        }
+
+    def do_print_(self, action):
+        """
+        Print all the gift cards issued in a single document, one card per
+        page, instead of one report per gift card.
+        """
+        ids = map(int, self.done.gift_cards)
+        return action, {
+            'id': ids[0],
+            'ids': ids,
+            'model': 'gift_card.gift_card',
+        }
+
+    def transition_print_(self):
+        return 'end'
+
+
+class GiftCardImportStart(ModelView):
+    "Gift Card Import Start View"
+    __name__ = 'gift_card.import.start'
+
+    file_ = fields.Binary('File', required=True)
+    format_ = fields.Selection([
+        ('csv', 'CSV'),
+        ('jsonl', 'JSON Lines'),
+    ], 'Format', required=True)
+    activate = fields.Boolean('Activate')
+
+    @staticmethod
+    def default_format_():
+        return 'csv'
+
+    @staticmethod
+    def default_activate():
+        return True
+
+
+class GiftCardImportDone(ModelView):
+    "Gift Card Import Done View"
+    __name__ = 'gift_card.import.end'
+
+    report = fields.Text('Import Report', readonly=True)
+
+
+class GiftCardImportWizard(Wizard):
+    "Gift Card Import Wizard"
+    __name__ = 'gift_card.import.wizard'
+
+    start = StateView(
+        'gift_card.import.start',
+        'gift_card.import_start_view_form',
+        [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True)
+        ]
+    )
+    import_ = StateTransition()
+    done = StateView(
+        'gift_card.import.end',
+        'gift_card.import_done_view_form',
+        [
+            Button('OK', 'end', 'tryton-ok')
+        ]
+    )
+
+    def transition_import_(self):
+        """
+        Import the gift cards of the file
+        """
+        GiftCard = Pool().get('gift_card.gift_card')
+
+        imported, rejected = GiftCard.import_file(
+            StringIO(str(self.start.file_)), self.start.format_,
+            activate=self.start.activate
+        )
+
+        lines = ['%d gift cards imported, %d rows rejected.' % (
+            imported, len(rejected)
+        )]
+        for line_num, error in rejected:
+            lines.append('Line %d: %s' % (line_num, error))
+        self.done.report = '\n'.join(lines)
+        return 'done'
+
+    def default_done(self, data):
+        """
+        Returns the report of the import
+        """
+        return {
+            'report': self.done.report,
+        }
+
+
+class GiftCardLiability(ModelSQL, ModelView):
+    "Gift Card Liability"
+    __name__ = 'gift_card.liability'
+
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    currency = fields.Many2One('currency.currency', 'Currency', readonly=True)
+    currency_digits = fields.Function(
+        fields.Integer('Currency Digits'),
+        'on_change_with_currency_digits'
+    )
+    year = fields.Integer('Year', readonly=True)
+    month = fields.Integer('Month', readonly=True)
+    gift_card_count = fields.Integer('Gift Cards', readonly=True)
+    amount = fields.Numeric(
+        'Amount Issued', digits=(16, Eval('currency_digits', 2)),
+        readonly=True, depends=['currency_digits']
+    )
+    amount_captured = fields.Numeric(
+        'Amount Captured', digits=(16, Eval('currency_digits', 2)),
+        readonly=True, depends=['currency_digits']
+    )
+    amount_authorized = fields.Numeric(
+        'Amount Authorized', digits=(16, Eval('currency_digits', 2)),
+        readonly=True, depends=['currency_digits']
+    )
+    amount_available = fields.Numeric(
+        'Outstanding Liability', digits=(16, Eval('currency_digits', 2)),
+        readonly=True, depends=['currency_digits']
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(GiftCardLiability, cls).__setup__()
+        cls._order.insert(0, ('year', 'DESC'))
+        cls._order.insert(1, ('month', 'DESC'))
+
+    @staticmethod
+    def table_query():
+        """
+        Aggregate the balance ledger of the active gift cards by company of
+        their sale, the default company for the gift cards not sold, currency
+        and month of activation in the database
+        """
+        pool = Pool()
+        GiftCard = pool.get('gift_card.gift_card')
+        SaleLine = pool.get('sale.line')
+        Sale = pool.get('sale.sale')
+        gift_card = GiftCard.__table__()
+        line = SaleLine.__table__()
+        sale = Sale.__table__()
+
+        company = Coalesce(sale.company, GiftCard.get_default_company())
+        year = Extract('YEAR', gift_card.activation_date)
+        month = Extract('MONTH', gift_card.activation_date)
+        return gift_card.join(
+            line, 'LEFT', condition=gift_card.sale_line == line.id
+        ).join(
+            sale, 'LEFT', condition=line.sale == sale.id
+        ).select(
+            Min(gift_card.id).as_('id'),
+            Literal(0).as_('create_uid'),
+            Now().as_('create_date'),
+            Literal(None).as_('write_uid'),
+            Literal(None).as_('write_date'),
+            company.as_('company'),
+            gift_card.currency.as_('currency'),
+            year.as_('year'),
+            month.as_('month'),
+            Count(gift_card.id).as_('gift_card_count'),
+            Sum(gift_card.amount).as_('amount'),
+            Sum(gift_card.amount_captured).as_('amount_captured'),
+            Sum(gift_card.amount_authorized).as_('amount_authorized'),
+            Sum(gift_card.amount_available).as_('amount_available'),
+            where=gift_card.state == 'active',
+            group_by=[company, gift_card.currency, year, month],
+        )
+
+    @fields.depends('currency')
+    def on_change_with_currency_digits(self, name=None):
+        if self.currency:
+            return self.currency.digits
+        return 2
+
+
+class GiftCardBalanceSnapshot(ModelSQL, ModelView):
+    "Gift Card Balance Snapshot"
+    __name__ = 'gift_card.balance.snapshot'
+
+    date = fields.Date('Date', required=True, readonly=True, select=True)
+    currency = fields.Many2One(
+        'currency.currency', 'Currency', required=True, readonly=True
+    )
+    currency_digits = fields.Function(
+        fields.Integer('Currency Digits'),
+        'on_change_with_currency_digits'
+    )
+    amount = fields.Numeric(
+        'Amount Issued', digits=(16, Eval('currency_digits', 2)),
+        required=True, readonly=True, depends=['currency_digits']
+    )
+    amount_captured = fields.Numeric(
+        'Amount Captured', digits=(16, Eval('currency_digits', 2)),
+        required=True, readonly=True, depends=['currency_digits']
+    )
+    amount_expired = fields.Numeric(
+        'Amount Expired', digits=(16, Eval('currency_digits', 2)),
+        required=True, readonly=True, depends=['currency_digits']
+    )
+    amount_canceled = fields.Numeric(
+        'Amount Canceled', digits=(16, Eval('currency_digits', 2)),
+        required=True, readonly=True, depends=['currency_digits']
+    )
+    amount_available = fields.Numeric(
+        'Outstanding Liability', digits=(16, Eval('currency_digits', 2)),
+        required=True, readonly=True, depends=['currency_digits']
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(GiftCardBalanceSnapshot, cls).__setup__()
+        cls._order.insert(0, ('date', 'DESC'))
+        cls._sql_constraints = [
+            ('date_currency_uniq', 'UNIQUE(date, currency)',
+             'There can be only one snapshot per date and currency.')
+        ]
+
+    @fields.depends('currency')
+    def on_change_with_currency_digits(self, name=None):
+        if self.currency:
+            return self.currency.digits
+        return 2
+
+    @classmethod
+    def _get_issued_amounts(cls, start_date, end_date):
+        """
+        Returns a dictionary of date and currency id with the amount of the
+        gift cards activated on this date, between the two dates included
+        """
+        GiftCard = Pool().get('gift_card.gift_card')
+        gift_card = GiftCard.__table__()
+        cursor = Transaction().cursor
+
+        where = gift_card.activation_date <= end_date
+        if start_date:
+            where &= gift_card.activation_date >= start_date
+        cursor.execute(*gift_card.select(
+            gift_card.activation_date, gift_card.currency,
+            Sum(gift_card.amount),
+            where=where,
+            group_by=[gift_card.activation_date, gift_card.currency],
+        ))
+        return dict(
+            ((date_, currency), amount)
+            for date_, currency, amount in cursor.fetchall()
+        )
+
+    @classmethod
+    def _get_canceled_amounts(cls, start_date, end_date):
+        """
+        Returns a dictionary of date and currency id with the amount not
+        captured of the active gift cards canceled on this date, between the
+        two dates included
+        """
+        GiftCard = Pool().get('gift_card.gift_card')
+        gift_card = GiftCard.__table__()
+        cursor = Transaction().cursor
+
+        where = gift_card.cancellation_date <= end_date
+        if start_date:
+            where &= gift_card.cancellation_date >= start_date
+        cursor.execute(*gift_card.select(
+            gift_card.cancellation_date, gift_card.currency,
+            Sum(gift_card.amount - gift_card.amount_captured),
+            where=where,
+            group_by=[gift_card.cancellation_date, gift_card.currency],
+        ))
+        return dict(
+            ((date_, currency), amount)
+            for date_, currency, amount in cursor.fetchall()
+        )
+
+    @classmethod
+    def _get_captured_amounts(cls, start_date, end_date):
+        """
+        Returns a dictionary of date and currency id with the amount
+        captured on gift cards on this date, between the two dates included
+        """
+        GiftCard = Pool().get('gift_card.gift_card')
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+        gift_card = GiftCard.__table__()
+        transaction = PaymentTransaction.__table__()
+        cursor = Transaction().cursor
+
+        where = transaction.state.in_(['posted', 'done'])
+        where &= transaction.date <= end_date
+        if start_date:
+            where &= transaction.date >= start_date
+        cursor.execute(*transaction.join(
+            gift_card, condition=transaction.gift_card == gift_card.id
+        ).select(
+            transaction.date, gift_card.currency, Sum(transaction.amount),
+            where=where,
+            group_by=[transaction.date, gift_card.currency],
+        ))
+        return dict(
+            ((date_, currency), amount)
+            for date_, currency, amount in cursor.fetchall()
+        )
+
+    @classmethod
+    def _get_expired_amounts(cls, start_date, end_date):
+        """
+        Returns a dictionary of date and currency id with the amount left on
+        the gift cards expired on this date, between the two dates included
+        """
+        GiftCard = Pool().get('gift_card.gift_card')
+        Move = Pool().get('account.move')
+        gift_card = GiftCard.__table__()
+        move = Move.__table__()
+        cursor = Transaction().cursor
+
+        where = gift_card.state == 'expired'
+        where &= move.date <= end_date
+        if start_date:
+            where &= move.date >= start_date
+        cursor.execute(*gift_card.join(
+            move, condition=gift_card.breakage_move == move.id
+        ).select(
+            move.date, gift_card.currency, Sum(gift_card.amount_available),
+            where=where,
+            group_by=[move.date, gift_card.currency],
+        ))
+        return dict(
+            ((date_, currency), amount)
+            for date_, currency, amount in cursor.fetchall()
+        )
+
+    @classmethod
+    def create_snapshots(cls, end_date=None):
+        """
+        Extend the daily snapshots of the gift card balances from the last
+        snapshot up to `end_date`, yesterday by default.
+
+        Only the gift cards activated, the amounts captured and the gift
+        cards expired or canceled since the last snapshot are aggregated, so
+        that the job stays cheap however long the history is. This method is
+        intended to be called by a cron.
+        """
+        GiftCard = Pool().get('gift_card.gift_card')
+        Date = Pool().get('ir.date')
+
+        if end_date is None:
+            end_date = Date.today() - timedelta(days=1)
+
+        names = [
+            'amount', 'amount_captured', 'amount_expired', 'amount_canceled'
+        ]
+        balances = {}
+        last_snapshots = cls.search([], limit=1)
+        if last_snapshots:
+            last_date = last_snapshots[0].date
+            start_date = last_date + timedelta(days=1)
+            for snapshot in cls.search([('date', '=', last_date)]):
+                balances[snapshot.currency.id] = dict(
+                    (name, getattr(snapshot, name)) for name in names
+                )
+        else:
+            start_date = None
+        if start_date and start_date > end_date:
+            return []
+
+        amounts = {
+            'amount': cls._get_issued_amounts(start_date, end_date),
+            'amount_captured': cls._get_captured_amounts(
+                start_date, end_date
+            ),
+            'amount_expired': cls._get_expired_amounts(start_date, end_date),
+            'amount_canceled': cls._get_canceled_amounts(
+                start_date, end_date
+            ),
+        }
+        keys = sum((a.keys() for a in amounts.itervalues()), [])
+        if start_date is None:
+            if not keys:
+                return []
+            start_date = min(d for d, _ in keys)
+
+        zero = Decimal('0')
+        vlist = []
+        day = start_date
+        while day <= end_date:
+            currencies = set(balances) | set(c for d, c in keys if d == day)
+            for currency in currencies:
+                balance = balances.setdefault(
+                    currency, dict((name, zero) for name in names)
+                )
+                for name in names:
+                    balance[name] += GiftCard._to_decimal(
+                        amounts[name].get((day, currency), zero)
+                    )
+                values = balance.copy()
+                values.update({
+                    'date': day,
+                    'currency': currency,
+                    'amount_available': (
+                        balance['amount'] - balance['amount_captured'] -
+                        balance['amount_expired'] - balance['amount_canceled']
+                    ),
+                })
+                vlist.append(values)
+            day += timedelta(days=1)
+        return cls.create(vlist)
+
+    @classmethod
+    def get_liability(cls, date_):
+        """
+        Returns a dictionary of currency id and the outstanding liability of
+        gift cards at the end of the given date, from the snapshots
+        """
+        return dict(
+            (s.currency.id, s.amount_available)
+            for s in cls.search([('date', '=', date_)])
+        )
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+    invoice.py
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from trytond.pool import PoolMeta, Pool
+from trytond.transaction import Transaction
+
+__all__ = ['Invoice']
+__metaclass__ = PoolMeta
+
+
+class Invoice:
+    "Invoice"
+    __name__ = 'account.invoice'
+
+    @classmethod
+    def get_gift_card_sale_lines(cls, invoices):
+        """
+        Returns the gift card sale lines invoiced by the given invoices whose
+        gift cards are created when the invoice is paid
+        """
+        SaleLine = Pool().get('sale.line')
+
+        lines = set()
+        for invoice in invoices:
+            for invoice_line in invoice.lines:
+                origin = invoice_line.origin
+                if isinstance(origin, SaleLine) and origin.is_gift_card and \
+                        origin.sale.gift_card_method == 'invoice':
+                    lines.add(origin)
+        return list(lines)
+
+    @classmethod
+    def paid(cls, invoices):
+        """
+        Create the gift cards of the sale lines invoiced as soon as the
+        invoices are paid
+        """
+        SaleLine = Pool().get('sale.line')
+
+        super(Invoice, cls).paid(invoices)
+
+        with Transaction().set_context(_check_access=False):
+            SaleLine.create_gift_cards_for_lines(
+                cls.get_gift_card_sale_lines(cls.browse(invoices))
+            )
@@ -5,6 +5,8 @@
     :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+from dateutil.relativedelta import relativedelta
+
 from trytond.model import fields, ModelSQL, ModelView
 from trytond.pool import PoolMeta
 
@@ -33,6 +35,12 @@ class Product:
         'product.product.gift_card.price', 'product', 'Gift Card Prices',
     )
 
+    gift_card_validity = fields.Integer(
+        "Gift Card Validity",
+        help='Number of months the gift cards sold are valid, '
+        'leave empty for gift cards which never expire'
+    )
+
     @staticmethod
     def default_gift_card_delivery_mode():
         return 'physical'
@@ -56,7 +64,9 @@ class Product:
                 'Gift Card minimum amount must be smaller than gift card '
                 'maximum amount',
             'negative_amount_not_allowed':
-                'Gift card amounts can not be negative'
+                'Gift card amounts can not be negative',
+            'negative_validity':
+                'Gift card validity of product %s can not be negative',
         })
 
     @classmethod
@@ -71,6 +81,8 @@ class Product:
 
             template.check_gc_min_max()
 
+            template.check_gift_card_validity()
+
     def check_gc_min_max(self):
         """
         Check minimum amount to be smaller than maximum amount
@@ -84,6 +96,23 @@ class Product:
         if self.gc_min > self.gc_max:
             self.raise_user_error("invalid_amount")
 
+    def check_gift_card_validity(self):
+        """
+        Check the validity of the gift cards is not negative
+        """
+        if self.gift_card_validity is not None and \
+                self.gift_card_validity < 0:
+            self.raise_user_error("negative_validity", self.rec_name)
+
+    def get_gift_card_expiry_date(self, date_):
+        """
+        Returns the expiry date of the gift cards of this product issued at
+        the given date, or None if they never expire
+        """
+        if not self.gift_card_validity:
+            return None
+        return date_ + relativedelta(months=self.gift_card_validity)
+
     def check_type_and_mode(self):
         """
         Type must be service only if delivery mode is virtual
@@ -5,9 +5,13 @@
     :copyright: (c) 2014-2015 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+from sql.aggregate import Count, Sum
+
 from trytond.model import fields, ModelView
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval, Bool
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.wizard import Wizard
 
 __all__ = [
@@ -164,62 +168,128 @@ class SaleLine:
             'unit': None,
         }
 
-    def create_gift_cards(self):
-        '''
-        Create the actual gift card for this line
-        '''
+    @classmethod
+    def get_gift_card_quantities_created(cls, lines):
+        """
+        Returns a dictionary of line id and the number of gift cards already
+        created for the line, counted in the database.
+        """
         GiftCard = Pool().get('gift_card.gift_card')
+        gift_card = GiftCard.__table__()
+        cursor = Transaction().cursor
+
+        quantities = dict((line.id, 0) for line in lines)
+        for sub_ids in grouped_slice(quantities.keys()):
+            cursor.execute(*gift_card.select(
+                gift_card.sale_line, Count(gift_card.id),
+                where=reduce_ids(gift_card.sale_line, sub_ids),
+                group_by=gift_card.sale_line,
+            ))
+            quantities.update(cursor.fetchall())
+        return quantities
 
-        if not self.is_gift_card:
-            # Not a gift card line
-            return None
+    @classmethod
+    def get_gift_card_quantities_paid(cls, lines):
+        """
+        Returns a dictionary of line id and the quantity of the line
+        invoiced in paid invoices, summed in the database.
+        """
+        InvoiceLine = Pool().get('account.invoice.line')
+        Invoice = Pool().get('account.invoice')
+        invoice_line = InvoiceLine.__table__()
+        invoice = Invoice.__table__()
+        cursor = Transaction().cursor
+
+        quantities = dict((line.id, 0) for line in lines)
+        for sub_ids in grouped_slice(quantities.keys()):
+            origins = ['%s,%d' % (cls.__name__, i) for i in sub_ids]
+            cursor.execute(*invoice_line.join(
+                invoice, condition=invoice_line.invoice == invoice.id
+            ).select(
+                invoice_line.origin, Sum(invoice_line.quantity),
+                where=invoice_line.origin.in_(origins) &
+                (invoice.state == 'paid'),
+                group_by=invoice_line.origin,
+            ))
+            for origin, quantity in cursor.fetchall():
+                quantities[int(origin.split(',')[1])] = quantity
+        return quantities
 
-        product = self.product
+    @classmethod
+    def create_gift_cards_for_lines(cls, lines):
+        """
+        Create the gift cards which are still to be created for the given
+        lines, whatever their sale, with a single create and a single
+        activation.
 
-        if product.allow_open_amount and not (
-            product.gc_min <= self.unit_price <= product.gc_max
-        ):
-            self.raise_user_error(
-                "amounts_out_of_range", (
-                    self.sale.currency.code, product.gc_min,
-                    self.sale.currency.code, product.gc_max
+        Returns the list of gift cards created.
+        """
+        GiftCard = Pool().get('gift_card.gift_card')
+        Date = Pool().get('ir.date')
+
+        lines = filter(lambda line: line.is_gift_card, lines)
+
+        for line in lines:
+            product = line.product
+            if product.allow_open_amount and not (
+                product.gc_min <= line.unit_price <= product.gc_max
+            ):
+                line.raise_user_error(
+                    "amounts_out_of_range", (
+                        line.sale.currency.code, product.gc_min,
+                        line.sale.currency.code, product.gc_max
+                    )
                 )
-            )
 
         # XXX: Do not consider cancelled ones in the gift cards.
         # card could have been cancelled for reasons like wrong message ?
-        quantity_created = len(self.gift_cards)
-
-        if self.sale.gift_card_method == 'order':
-            quantity = self.quantity - quantity_created
-        else:
-            # On invoice paid
-            quantity_paid = 0
-            for invoice_line in self.invoice_lines:
-                if invoice_line.invoice.state == 'paid':
-                    invoice_line.quantity
-                    quantity_paid += invoice_line.quantity
+        quantities_created = cls.get_gift_card_quantities_created(lines)
+        quantities_paid = cls.get_gift_card_quantities_paid([
+            line for line in lines
+            if line.sale.gift_card_method == 'invoice'
+        ])
+
+        today = Date.today()
+        vlist = []
+        for line in lines:
+            if line.sale.gift_card_method == 'order':
+                quantity = line.quantity
+            else:
+                # On invoice paid
+                quantity = quantities_paid[line.id]
 
             # Remove already created gift cards
-            quantity = quantity_paid - quantity_created
-
-        if not quantity > 0:
+            quantity -= quantities_created[line.id]
+
+            vlist.extend({
+                'amount': line.unit_price,
+                'sale_line': line.id,
+                'message': line.message,
+                'recipient_email': line.recipient_email,
+                'recipient_name': line.recipient_name,
+                'origin': '%s,%d' % (line.sale.__name__, line.sale.id),
+                'expiry_date': line.product.get_gift_card_expiry_date(today),
+            } for each in range(0, int(quantity)))
+
+        if not vlist:
             # No more gift cards to create
-            return
-
-        gift_cards = GiftCard.create([{
-            'amount': self.unit_price,
-            'sale_line': self.id,
-            'message': self.message,
-            'recipient_email': self.recipient_email,
-            'recipient_name': self.recipient_name,
-            'origin': '%s,%d' % (self.sale.__name__, self.sale.id),
-        } for each in range(0, int(quantity))])
+            return []
 
+        gift_cards = GiftCard.create(vlist)
         GiftCard.activate(gift_cards)
 
         return gift_cards
 
+    def create_gift_cards(self):
+        '''
+        Create the actual gift card for this line
+        '''
+        if not self.is_gift_card:
+            # Not a gift card line
+            return None
+
+        return self.create_gift_cards_for_lines([self]) or None
+
 
 class Sale:
     "Sale"
@@ -248,8 +318,9 @@ class Sale:
         '''
         Create the gift cards if not already created
         '''
-        for line in filter(lambda l: l.is_gift_card, self.lines):
-            line.create_gift_cards()
+        SaleLine = Pool().get('sale.line')
+
+        SaleLine.create_gift_cards_for_lines(self.lines)
 
     @classmethod
     def get_payment_method_priority(cls):
@@ -266,12 +337,18 @@ class Sale:
         Create gift card on processing sale
         """
 
+        SaleLine = Pool().get('sale.line')
+
         super(Sale, cls).process(sales)
 
-        for sale in sales:
-            if sale.state not in ('confirmed', 'processing', 'done'):
-                continue        # pragma: no cover
-            sale.create_gift_cards()
+        # Create the gift cards of all the sales at once. The gift cards
+        # created on invoice paid are created when the invoice is paid.
+        SaleLine.create_gift_cards_for_lines([
+            line for sale in sales
+            if sale.state in ('confirmed', 'processing', 'done') and
+            sale.gift_card_method == 'order'
+            for line in sale.lines
+        ])
 
 
 class Payment:
@@ -302,19 +379,41 @@ class Payment:
         """
         super(Payment, cls).validate(payments)
 
+        cls.check_gift_card_amounts(payments)
+
+    @classmethod
+    def check_gift_card_amounts(cls, payments):
+        """
+        Payments should not be created if their gift card has insufficient
+        amount to pay all of them.
+
+        The payments are grouped by gift card so that the amount available
+        on each gift card is read once and checked against the total amount
+        of the payments using it.
+        """
+        payments_by_gift_card = {}
         for payment in payments:
-            payment.check_gift_card_amount()
+            if payment.gift_card:
+                payments_by_gift_card.setdefault(
+                    payment.gift_card, []
+                ).append(payment)
+
+        for gift_card, gift_card_payments in \
+                payments_by_gift_card.iteritems():
+            amount = sum(p.amount for p in gift_card_payments)
+            if gift_card.amount_available < amount:
+                cls.raise_user_error(
+                    'insufficient_amount', (
+                        gift_card.number,
+                        gift_card_payments[0].sale.currency.code, amount,
+                    )
+                )
 
     def check_gift_card_amount(self):
         """
         Payment should not be created if gift card has insufficient amount
         """
-        if self.gift_card and self.gift_card.amount_available < self.amount:
-            self.raise_user_error(
-                'insufficient_amount', (
-                    self.gift_card.number, self.sale.currency.code, self.amount,
-                )
-            )
+        self.check_gift_card_amounts([self])
 
     @classmethod
     def __setup__(cls):
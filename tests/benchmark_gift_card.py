@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/benchmark_gift_card.py
+
+    Timings of the gift card operations which are called in bulk, run with:
+
+        python tests/benchmark_gift_card.py
+
+    The methods are not collected with the tests as they only report
+    timings.
+
+    :copyright: (c) 2014-2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import time
+import unittest
+from decimal import Decimal
+
+from jinja2 import Environment, PackageLoader
+
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+from test_base import TestBase
+
+
+class GiftCardBenchmark(TestBase):
+    '''
+    Benchmark Gift Card
+    '''
+
+    def timeit(self, label, function, count):
+        """
+        Calls `function` `count` times with the number of the call and
+        prints the time taken
+        """
+        start = time.time()
+        for i in xrange(count):
+            function(i)
+        elapsed = time.time() - start
+        sys.stderr.write('\n%-40s %6d calls %8.3f s %8.3f ms/call\n' % (
+            label, count, elapsed, elapsed * 1000 / count
+        ))
+        return elapsed
+
+    def benchmark_email_templates(self):
+        """
+        Render the gift card emails with the templates compiled once per
+        process and with an environment created for each email
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+        Sale = POOL.get('sale.sale')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+                sale, = Sale.create([{
+                    'reference': 'Sale1',
+                    'invoice_address': self.party1.addresses[0].id,
+                    'shipment_address': self.party1.addresses[0].id,
+                    'party': self.party1.id,
+                    'lines': [
+                        ('create', [{
+                            'quantity': 1,
+                            'unit': self.uom,
+                            'unit_price': 150,
+                            'description': 'Gift Card',
+                            'product': self.product.id,
+                        }]),
+                    ],
+                }])
+                gift_card, = GiftCard.create([{
+                    'sale_line': sale.lines[0].id,
+                    'amount': Decimal('150'),
+                    'number': '45671338',
+                    'recipient_email': 'test@example.com',
+                    'recipient_name': 'John Doe',
+                    'state': 'active',
+                }])
+
+                def render_shared(i):
+                    html_template, text_template = \
+                        gift_card._get_email_templates()
+                    html_template.render(card=gift_card)
+                    text_template.render(card=gift_card)
+
+                def render_new_environment(i):
+                    env = Environment(loader=PackageLoader(
+                        'trytond.modules.gift_card', 'emails'
+                    ))
+                    for name in ('gift_card_html.html', 'gift_card_text.html'):
+                        env.get_template(name).render(card=gift_card)
+
+                shared = self.timeit(
+                    'email templates, shared environment', render_shared, 1000
+                )
+                new = self.timeit(
+                    'email templates, new environment', render_new_environment,
+                    1000
+                )
+                self.assertLess(shared, new)
+
+    def benchmark_balance_inquiry(self):
+        """
+        Inquire the balance of gift cards by number with `get_balance` and
+        with the gift cards instantiated and their amounts computed from
+        their transactions
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+                GiftCard.create([{
+                    'amount': Decimal('150'),
+                    'number': '%08d' % i,
+                    'state': 'active',
+                } for i in xrange(1000)])
+
+                def get_balance(i):
+                    GiftCard.get_balance('%08d' % i)
+
+                def get_amount(i):
+                    gift_card, = GiftCard.search([('number', '=', '%08d' % i)])
+                    GiftCard.get_amount([gift_card], ['amount_available'])
+                    gift_card.state
+                    gift_card.currency.code
+
+                inquiry = self.timeit(
+                    'balance inquiry, get_balance', get_balance, 1000
+                )
+                self.timeit(
+                    'balance inquiry, get_balance cached', get_balance, 1000
+                )
+                orm = self.timeit(
+                    'balance inquiry, get_amount', get_amount, 1000
+                )
+                self.assertLess(inquiry, orm)
+
+    def benchmark_redemption(self):
+        """
+        Redeem gift cards with `redeem` and with the redeem wizard run the
+        way a client runs it
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+        RedeemWizard = POOL.get('gift_card.redeem.wizard', type='wizard')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+                gateway = self.create_payment_gateway()
+                gift_cards = GiftCard.create([{
+                    'amount': Decimal('150'),
+                    'number': '%08d' % i,
+                    'state': 'active',
+                } for i in xrange(1000)])
+
+                def redeem(i):
+                    GiftCard.redeem(
+                        '%08d' % i, Decimal('10'), self.party1.id,
+                        description='Redemption'
+                    )
+
+                def redeem_wizard(i):
+                    gift_card = gift_cards[500 + i]
+                    with Transaction().set_context(active_ids=[gift_card.id]):
+                        session_id, start_state, _ = RedeemWizard.create()
+                        RedeemWizard.execute(session_id, {}, start_state)
+                        RedeemWizard.execute(session_id, {
+                            start_state: {
+                                'description': 'Redemption',
+                                'gateway': gateway.id,
+                                'party': self.party1.id,
+                                'address': self.party1.addresses[0].id,
+                                'amount': Decimal('10'),
+                                'gift_card': gift_card.id,
+                                'currency': self.usd.id,
+                            },
+                        }, 'redeem')
+                        RedeemWizard.delete(session_id)
+
+                rpc = self.timeit('redemption, redeem', redeem, 500)
+                wizard = self.timeit(
+                    'redemption, redeem wizard', redeem_wizard, 500
+                )
+                self.assertLess(rpc, wizard)
+
+
+def suite():
+    """
+    Define suite
+    """
+    loader = unittest.TestLoader()
+    loader.testMethodPrefix = 'benchmark'
+    return loader.loadTestsFromTestCase(GiftCardBenchmark)
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -6,18 +6,38 @@
     :license: BSD, see LICENSE for more details.
 """
 import unittest
-from datetime import date
+import threading
+import Queue
+import json
+import logging
+from StringIO import StringIO
+from datetime import date, timedelta
 
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
 from trytond.transaction import Transaction
+from trytond import backend
 from decimal import Decimal
 from test_base import TestBase
 from trytond.exceptions import UserError
 from trytond.config import config
+from trytond.modules.gift_card.gift_card import logger
 config.set('email', 'from', 'test@ol.in')
 
 
+class LogHandler(logging.Handler):
+    '''
+    Logging handler keeping the messages logged
+    '''
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
 class TestGiftCard(TestBase):
     '''
     Test Gift Card
@@ -679,6 +699,172 @@ class TestGiftCard(TestBase):
             gift_card2, = GiftCard.copy([gift_card])
             self.assertNotEqual(gift_card2.number, number)
 
+    def test0052_issue_gift_cards(self):
+        """
+        Issue gift cards in bulk with numbers reserved by block
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+        IssueWizard = POOL.get('gift_card.issue.wizard', type='wizard')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+
+                gift_card, = GiftCard.create([{
+                    'amount': Decimal('20'),
+                }])
+                first_number = int(gift_card.number)
+
+                gift_cards = GiftCard.issue(5, {
+                    'amount': Decimal('50'),
+                    'currency': self.usd.id,
+                }, chunk_size=2)
+
+                self.assertEqual(len(gift_cards), 5)
+                self.assertEqual(
+                    [g.number for g in gift_cards],
+                    [str(first_number + i) for i in range(1, 6)]
+                )
+                self.assertTrue(all(
+                    g.state == 'draft' and g.amount_available == 50
+                    for g in gift_cards
+                ))
+
+                # Numbers given explicitly are not taken from the sequence
+                gift_card1, gift_card2 = GiftCard.create([{
+                    'amount': Decimal('20'),
+                    'number': 'EXT-1',
+                }, {
+                    'amount': Decimal('20'),
+                }])
+                self.assertEqual(gift_card1.number, 'EXT-1')
+                self.assertEqual(gift_card2.number, str(first_number + 6))
+
+                session_id, _, _ = IssueWizard.create()
+                issue = IssueWizard(session_id)
+                issue.start.quantity = 3
+                issue.start.amount = Decimal('100')
+                issue.start.currency = self.usd
+                issue.start.activate = True
+                issue.start.comment = 'Corporate order'
+
+                self.assertEqual(issue.transition_issue(), 'done')
+                self.assertEqual(
+                    issue.default_done({})['done_msg'],
+                    '3 gift cards issued, numbered %d to %d.' % (
+                        first_number + 7, first_number + 9
+                    )
+                )
+                self.assertEqual(GiftCard.search([
+                    ('state', '=', 'active'),
+                    ('comment', '=', 'Corporate order'),
+                ], count=True), 3)
+
+                # All the cards issued are printed in one document
+                issued = GiftCard.search([
+                    ('comment', '=', 'Corporate order'),
+                ], order=[('id', 'ASC')])
+                self.assertEqual(issue.done.gift_cards, issued)
+                action, data = issue.do_print_({})
+                self.assertEqual(data['ids'], map(int, issued))
+                self.assertEqual(issue.transition_print_(), 'end')
+
+                GiftCardReport = POOL.get(
+                    'gift_card.gift_card', type='report'
+                )
+                val = GiftCardReport.execute(data['ids'], data)
+                self.assertEqual(val[0], 'odt')
+                self.assertFalse(any(g.report_cache for g in issued))
+
+                issue.start.quantity = 0
+                with self.assertRaises(UserError):
+                    issue.transition_issue()
+
+    def test0054_import_gift_cards(self):
+        """
+        Import legacy gift cards from CSV and JSON Lines files
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+        ImportWizard = POOL.get('gift_card.import.wizard', type='wizard')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+
+                GiftCard.create([{
+                    'amount': Decimal('20'),
+                    'number': 'L-0',
+                }])
+
+                data = '\n'.join([
+                    'number,amount,currency,recipient_name',
+                    'L-1,25.50,USD,John Doe',
+                    'L-2,100,,',
+                    'L-0,10,USD,',
+                    ',10,USD,',
+                    'L-3,abc,USD,',
+                    'L-4,10,XXX,',
+                    'L-1,10,USD,',
+                    'L-5,-10,USD,',
+                    'L-6,10,USD,Jane Doe',
+                ])
+                handler = LogHandler()
+                logger.addHandler(handler)
+                logger.setLevel(logging.INFO)
+                try:
+                    imported, rejected = GiftCard.import_file(
+                        StringIO(data), 'csv', chunk_size=2
+                    )
+                finally:
+                    logger.removeHandler(handler)
+                    logger.setLevel(logging.NOTSET)
+                self.assertEqual(imported, 3)
+                # The progress is logged once per chunk
+                self.assertEqual(len(handler.messages), 5)
+                self.assertEqual(
+                    handler.messages[-1],
+                    'Gift card import up to line 10: 3 imported, 6 rejected'
+                )
+                self.assertEqual(
+                    [line_num for line_num, _ in rejected],
+                    [4, 5, 6, 7, 8, 9]
+                )
+
+                gift_card, = GiftCard.search([('number', '=', 'L-1')])
+                self.assertEqual(gift_card.amount, Decimal('25.50'))
+                self.assertEqual(gift_card.amount_available, Decimal('25.50'))
+                self.assertEqual(gift_card.currency, self.usd)
+                self.assertEqual(gift_card.recipient_name, 'John Doe')
+                self.assertEqual(gift_card.state, 'draft')
+                self.assertTrue(gift_card.is_email_sent)
+
+                session_id, _, _ = ImportWizard.create()
+                import_ = ImportWizard(session_id)
+                import_.start.file_ = '\n'.join([
+                    '{"number": "J-1", "amount": "40"}',
+                    '',
+                    'not json',
+                    '{"number": "J-2", "amount": 15.5, "currency": "USD"}',
+                    '{"number": 1001, "amount": 10, "recipient_name": 42}',
+                    '{"number": 1001, "amount": 10}',
+                ])
+                import_.start.format_ = 'jsonl'
+                import_.start.activate = True
+                self.assertEqual(import_.transition_import_(), 'done')
+                report = import_.default_done({})['report']
+                self.assertTrue(report.startswith(
+                    '3 gift cards imported, 2 rows rejected.\nLine 3: '
+                ))
+                self.assertIn('Line 6: ', report)
+                self.assertEqual(GiftCard.search([
+                    ('number', 'in', ['J-1', 'J-2', '1001']),
+                    ('state', '=', 'active'),
+                ], count=True), 3)
+                gift_card, = GiftCard.search([('number', '=', '1001')])
+                self.assertEqual(gift_card.recipient_name, '42')
+
     def test0050_authorize_gift_card_payment_gateway_valid_card(self):
         """
         Test gift card authorization
@@ -1052,35 +1238,84 @@ class TestGiftCard(TestBase):
             self.assertEqual(active_gift_card.amount_captured, 30)
             self.assertEqual(active_gift_card.amount_available, 80)
 
-    def test0080_test_gift_card_report(self):
+    def test0075_gift_card_amount_multiple_cards(self):
         """
-        Test Gift Card report
+        Check amounts computed for several gift cards at once
         """
         GiftCard = POOL.get('gift_card.gift_card')
-        GiftCardReport = POOL.get('gift_card.gift_card', type='report')
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
 
             with Transaction().set_context({'company': self.company.id}):
 
-                gift_card, = GiftCard.create([{
+                gift_card1, gift_card2, gift_card3 = GiftCard.create([{
                     'amount': Decimal('200'),
                     'number': '45671338',
                     'state': 'active',
+                }, {
+                    'amount': Decimal('100'),
+                    'number': '45671339',
+                    'state': 'active',
+                }, {
+                    'amount': Decimal('50'),
+                    'number': '45671340',
+                    'state': 'active',
                 }])
 
-                val = GiftCardReport.execute([gift_card.id], {})
-
-                self.assert_(val)
-                # Assert report name
-                self.assertEqual(val[3], 'Gift Card')
+                gateway = self.create_payment_gateway()
 
-    def test0090_test_gift_card_deletion(self):
+                transactions = PaymentTransaction.create([{
+                    'description': 'Payment Transaction %s' % index,
+                    'party': self.party1.id,
+                    'address': self.party1.addresses[0].id,
+                    'amount': amount,
+                    'currency': self.company.currency.id,
+                    'gateway': gateway.id,
+                    'gift_card': gift_card.id,
+                    'credit_account': self.party1.account_receivable.id,
+                } for index, (gift_card, amount) in enumerate([
+                    (gift_card1, Decimal('70')),
+                    (gift_card1, Decimal('30')),
+                    (gift_card2, Decimal('40')),
+                ])])
+
+                PaymentTransaction.authorize([transactions[0]])
+                PaymentTransaction.capture(transactions[1:])
+
+                result = GiftCard.get_amount(
+                    [gift_card1, gift_card2, gift_card3], [
+                        'amount_authorized', 'amount_captured',
+                        'amount_available'
+                    ]
+                )
+                self.assertEqual(result['amount_authorized'], {
+                    gift_card1.id: Decimal('70'),
+                    gift_card2.id: Decimal('0'),
+                    gift_card3.id: Decimal('0'),
+                })
+                self.assertEqual(result['amount_captured'], {
+                    gift_card1.id: Decimal('30'),
+                    gift_card2.id: Decimal('40'),
+                    gift_card3.id: Decimal('0'),
+                })
+                self.assertEqual(result['amount_available'], {
+                    gift_card1.id: Decimal('100'),
+                    gift_card2.id: Decimal('60'),
+                    gift_card3.id: Decimal('50'),
+                })
+
+    def test0077_gift_card_balance_ledger(self):
         """
-        Test that Gift Card should not be deleted in active state
+        Check the balance ledger is maintained by the transactions and can
+        be reconciled with them
         """
         GiftCard = POOL.get('gift_card.gift_card')
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+        ReconcileWizard = POOL.get(
+            'gift_card.reconcile.wizard', type='wizard'
+        )
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
@@ -1092,182 +1327,715 @@ class TestGiftCard(TestBase):
                     'number': '45671338',
                     'state': 'active',
                 }])
+                self.assertEqual(gift_card.amount_authorized, Decimal('0'))
+                self.assertEqual(gift_card.amount_captured, Decimal('0'))
+                self.assertEqual(gift_card.amount_available, Decimal('200'))
+
+                # The ledger can not be written
+                for name in [
+                        'amount_authorized', 'amount_captured',
+                        'amount_available']:
+                    with self.assertRaises(UserError):
+                        GiftCard.write([gift_card], {name: Decimal('1000')})
+                self.assertEqual(gift_card.amount_available, Decimal('200'))
 
-                with self.assertRaises(Exception):
-                    GiftCard.delete([gift_card])
+                gateway = self.create_payment_gateway()
 
-                # Try to delete gift card in some other state and it will
-                # be deleted
-                gift_card, = GiftCard.create([{
-                    'amount': Decimal('200'),
-                    'number': '45671339',
-                    'state': 'draft',
-                }])
+                transaction1, transaction2 = PaymentTransaction.create([{
+                    'description': 'Payment Transaction %s' % amount,
+                    'party': self.party1.id,
+                    'address': self.party1.addresses[0].id,
+                    'amount': amount,
+                    'currency': self.company.currency.id,
+                    'gateway': gateway.id,
+                    'gift_card': gift_card.id,
+                    'credit_account': self.party1.account_receivable.id,
+                } for amount in (Decimal('70'), Decimal('30'))])
+
+                PaymentTransaction.authorize([transaction1])
+                self.assertEqual(gift_card.amount_authorized, Decimal('70'))
+                self.assertEqual(gift_card.amount_available, Decimal('130'))
+
+                PaymentTransaction.capture([transaction2])
+                self.assertEqual(gift_card.amount_captured, Decimal('30'))
+                self.assertEqual(gift_card.amount_available, Decimal('100'))
+
+                PaymentTransaction.settle([transaction1])
+                self.assertEqual(gift_card.amount_authorized, Decimal('0'))
+                self.assertEqual(gift_card.amount_captured, Decimal('100'))
+                self.assertEqual(gift_card.amount_available, Decimal('100'))
+
+                # Nothing to reconcile
+                self.assertEqual(GiftCard.reconcile_balances([gift_card]), [])
+
+                # Make the ledger drift from the transactions
+                table = GiftCard.__table__()
+                Transaction().cursor.execute(*table.update(
+                    columns=[table.amount_captured, table.amount_available],
+                    values=[Decimal('10'), Decimal('190')],
+                    where=table.id == gift_card.id
+                ))
+                GiftCard._clear_balance_cache([gift_card.id])
+
+                with Transaction().set_context(active_ids=[gift_card.id]):
+                    session_id, _, _ = ReconcileWizard.create()
+                    reconcile = ReconcileWizard(session_id)
+                    self.assertEqual(reconcile.transition_reconcile(), 'done')
+                    self.assertTrue(
+                        '2 drifts corrected' in
+                        reconcile.default_done({})['report']
+                    )
 
-                GiftCard.delete([gift_card])
+                self.assertEqual(gift_card.amount_captured, Decimal('100'))
+                self.assertEqual(gift_card.amount_available, Decimal('100'))
 
-    def test0100_send_virtual_gift_cards(self):
+    def test0078_search_order_gift_card_amounts(self):
         """
-        Check if virtual gift cards are sent through email
+        Check gift cards can be searched and ordered on their amounts
         """
-        Sale = POOL.get('sale.sale')
         GiftCard = POOL.get('gift_card.gift_card')
-        Invoice = POOL.get('account.invoice')
-        Configuration = POOL.get('gift_card.configuration')
-        SaleLine = POOL.get('sale.line')
-        EmailQueue = POOL.get('email.queue')
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
-
             self.setup_defaults()
 
-            gift_card_product = self.create_product(
-                type='service', mode='virtual', is_gift_card=True
-            )
-
             with Transaction().set_context({'company': self.company.id}):
 
-                Configuration.create([{
-                    'liability_account': self._get_account_by_kind('revenue').id
+                gift_card1, gift_card2, gift_card3 = GiftCard.create([{
+                    'amount': Decimal('200'),
+                    'number': '45671338',
+                    'state': 'active',
+                }, {
+                    'amount': Decimal('100'),
+                    'number': '45671339',
+                    'state': 'active',
+                }, {
+                    'amount': Decimal('50'),
+                    'number': '45671340',
+                    'state': 'active',
                 }])
-                gc_price, _, = gift_card_product.gift_card_prices
-                sale, = Sale.create([{
-                    'reference': 'Sale1',
-                    'sale_date': date.today(),
-                    'invoice_address': self.party1.addresses[0].id,
-                    'shipment_address': self.party1.addresses[0].id,
+
+                gateway = self.create_payment_gateway()
+
+                transaction1, transaction2 = PaymentTransaction.create([{
+                    'description': 'Payment Transaction',
                     'party': self.party1.id,
-                    'lines': [
-                        ('create', [{
-                            'type': 'line',
-                            'quantity': 2,
-                            'unit': self.uom,
-                            'unit_price': 200,
-                            'description': 'Test description1',
-                            'product': self.product.id,
-                        }, {
-                            'quantity': 1,
-                            'unit': self.uom,
-                            'unit_price': 500,
-                            'description': 'Gift Card',
-                            'product': gift_card_product,
-                            'recipient_email': 'test@gift_card.com',
-                            'recipient_name': 'John Doe',
-                            'gc_price': gc_price.id
-                        }, {
-                            'type': 'comment',
-                            'description': 'Test line',
-                        }])
-                    ]
+                    'address': self.party1.addresses[0].id,
+                    'amount': amount,
+                    'currency': self.company.currency.id,
+                    'gateway': gateway.id,
+                    'gift_card': gift_card.id,
+                    'credit_account': self.party1.account_receivable.id,
+                } for gift_card, amount in [
+                    (gift_card1, Decimal('180')),
+                    (gift_card3, Decimal('50')),
+                ]])
+                PaymentTransaction.capture([transaction1, transaction2])
+
+                self.assertEqual(GiftCard.search([
+                    ('state', '=', 'active'),
+                    ('amount_available', '>', 0),
+                ], order=[('amount_available', 'DESC')]), [
+                    gift_card2, gift_card1
+                ])
+                self.assertEqual(GiftCard.search([
+                    ('amount_captured', '>=', Decimal('50')),
+                ], order=[('amount_captured', 'ASC')]), [
+                    gift_card3, gift_card1
+                ])
 
-                }])
+    def test0079_export_gift_card_balances(self):
+        """
+        Export the gift cards with their balance by pages
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
 
-                gift_card_line, = SaleLine.search([
-                    ('sale', '=', sale.id),
-                    ('product', '=', gift_card_product.id),
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+
+                gift_card1, gift_card2, gift_card3 = GiftCard.create([{
+                    'amount': Decimal('150'),
+                    'number': '1001',
+                }, {
+                    'amount': Decimal('50'),
+                    'number': '1002',
+                }, {
+                    'amount': Decimal('20'),
+                    'number': '1003',
+                }])
+                GiftCard.update_balances({
+                    gift_card1.id: (Decimal('20'), Decimal('30')),
+                })
+
+                data, last_id = GiftCard.export_balances(limit=2)
+                self.assertEqual(last_id, gift_card2.id)
+                self.assertEqual(data.splitlines(), [
+                    'number,state,currency,amount,amount_authorized,'
+                    'amount_captured,amount_available',
+                    '1001,draft,USD,150,20,30,100',
+                    '1002,draft,USD,50,0,0,50',
                 ])
 
+                data, last_id = GiftCard.export_balances(
+                    'jsonl', after=last_id, limit=2
+                )
+                self.assertEqual(last_id, gift_card3.id)
+                self.assertEqual(json.loads(data), {
+                    'number': '1003',
+                    'state': 'draft',
+                    'currency': 'USD',
+                    'amount': '20',
+                    'amount_authorized': '0',
+                    'amount_captured': '0',
+                    'amount_available': '20',
+                })
+
                 self.assertEqual(
-                    gift_card_line.gift_card_delivery_mode, 'virtual'
+                    GiftCard.export_balances(after=last_id), ('', last_id)
                 )
 
-                Sale.quote([sale])
+                output = StringIO()
+                GiftCard.export_file(output, 'jsonl')
+                self.assertEqual(len(output.getvalue().splitlines()), 3)
 
-                Sale.confirm([sale])
+    def test0079_gift_card_balance_snapshots(self):
+        """
+        Test the daily snapshots of the gift card balances
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+        Snapshot = POOL.get('gift_card.balance.snapshot')
 
-                # No gift card yet
-                self.assertFalse(
-                    GiftCard.search([('sale_line', '=', gift_card_line.id)])
-                )
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
 
-                # No Email is being sent yet
-                self.assertFalse(
-                    EmailQueue.search([
-                        ('to_addrs', '=', gift_card_line.recipient_email),
-                    ])
-                )
+            with Transaction().set_context({'company': self.company.id}):
 
-                self.SalePayment.create([{
-                    'sale': sale.id,
+                today = date.today()
+                self.assertEqual(Snapshot.create_snapshots(today), [])
+
+                GiftCard.create([{
+                    'amount': Decimal('100'),
+                    'number': '1001',
+                    'state': 'active',
+                }, {
+                    'amount': Decimal('50'),
+                    'number': '1002',
+                    'state': 'active',
+                }, {
                     'amount': Decimal('1000'),
-                    'gateway': self.create_payment_gateway('manual'),
-                    'credit_account': self.party1.account_receivable.id,
+                    'number': '1003',
                 }])
+                self.create_payment_gateway()
+                GiftCard.redeem('1001', Decimal('30'), self.party1.id)
 
-                Sale.process([sale])
+                snapshot, = Snapshot.create_snapshots(today)
+                self.assertEqual(snapshot.date, today)
+                self.assertEqual(snapshot.currency, self.usd)
+                self.assertEqual(snapshot.amount, Decimal('150'))
+                self.assertEqual(snapshot.amount_captured, Decimal('30'))
+                self.assertEqual(snapshot.amount_available, Decimal('120'))
 
-                # Gift card is created
-                self.assertTrue(
-                    GiftCard.search([('sale_line', '=', gift_card_line.id)])
-                )
+                # Already up to date
+                self.assertEqual(Snapshot.create_snapshots(today), [])
 
-                self.assertEqual(
-                    GiftCard.search(
-                        [('sale_line', '=', gift_card_line.id)], count=True
-                    ), 1
+                # Days without activity carry the balance over
+                snapshots = Snapshot.create_snapshots(
+                    today + timedelta(days=2)
                 )
-
-                self.assertEqual(Invoice.search([], count=True), 1)
-
-                gift_card, = GiftCard.search([
-                    ('sale_line', '=', gift_card_line.id)
-                ])
-
                 self.assertEqual(
-                    gift_card.recipient_email, gift_card_line.recipient_email
+                    [s.date for s in snapshots],
+                    [today + timedelta(days=1), today + timedelta(days=2)]
                 )
-
                 self.assertEqual(
-                    gift_card.recipient_name, gift_card_line.recipient_name
+                    Snapshot.get_liability(today + timedelta(days=2)),
+                    {self.usd.id: Decimal('120')}
                 )
-
-                # Email is being sent
-                self.assertTrue(
-                    EmailQueue.search([
-                        ('to_addrs', '=', gift_card_line.recipient_email),
-                    ])
+                self.assertEqual(
+                    Snapshot.get_liability(today - timedelta(days=1)), {}
                 )
 
-    def test0110_test_sending_email_multiple_times(self):
+    def test0079_gift_card_balance_snapshots_of_later_activations(self):
         """
-        Test that email should not be sent multiple times for gift card
+        Gift cards count in the snapshots from the day they are activated
+        until the day they are canceled
         """
         GiftCard = POOL.get('gift_card.gift_card')
-        EmailQueue = POOL.get('email.queue')
-        Sale = POOL.get('sale.sale')
-        SaleLine = POOL.get('sale.line')
+        Snapshot = POOL.get('gift_card.balance.snapshot')
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
 
             with Transaction().set_context({'company': self.company.id}):
-                gift_card_product = self.create_product(
-                    type='service', mode='virtual', is_gift_card=True,
-                )
 
-                gc_price, _, = gift_card_product.gift_card_prices
+                today = date.today()
+                yesterday = today - timedelta(days=1)
 
-                sale, = Sale.create([{
+                gift_card1, gift_card2, gift_card3 = GiftCard.create([{
+                    'amount': Decimal('10'),
+                    'number': '1001',
+                    'state': 'active',
+                    'activation_date': yesterday,
+                }, {
+                    'amount': Decimal('100'),
+                    'number': '1002',
+                }, {
+                    'amount': Decimal('20'),
+                    'number': '1003',
+                }])
+                self.assertIsNone(gift_card2.activation_date)
+
+                snapshot, = Snapshot.create_snapshots(yesterday)
+                self.assertEqual(snapshot.amount_available, Decimal('10'))
+
+                GiftCard.activate([gift_card2])
+                self.assertEqual(gift_card2.activation_date, today)
+                self.create_payment_gateway()
+                GiftCard.redeem('1002', Decimal('60'), self.party1.id)
+
+                # Only the active gift cards canceled end a liability
+                GiftCard.cancel([gift_card1, gift_card3])
+                self.assertEqual(gift_card1.cancellation_date, today)
+                self.assertIsNone(gift_card3.cancellation_date)
+
+                snapshot, = Snapshot.create_snapshots(today)
+                self.assertEqual(snapshot.amount, Decimal('110'))
+                self.assertEqual(snapshot.amount_captured, Decimal('60'))
+                self.assertEqual(snapshot.amount_canceled, Decimal('10'))
+                self.assertEqual(snapshot.amount_available, Decimal('40'))
+
+                GiftCard.draft([gift_card1])
+                self.assertIsNone(gift_card1.activation_date)
+                self.assertIsNone(gift_card1.cancellation_date)
+
+    def test0079_gift_card_liability(self):
+        """
+        Test the outstanding liability of gift cards aggregated in SQL
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+        Liability = POOL.get('gift_card.liability')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+
+                eur, = self.Currency.create([{
+                    'name': 'Euro',
+                    'code': 'EUR',
+                    'symbol': 'E',
+                }])
+                sale, = POOL.get('sale.sale').create([{
                     'reference': 'Sale1',
                     'sale_date': date.today(),
                     'invoice_address': self.party1.addresses[0].id,
                     'shipment_address': self.party1.addresses[0].id,
                     'party': self.party1.id,
-                    'lines': [
-                        ('create', [{
-                            'type': 'line',
-                            'quantity': 2,
-                            'unit': self.uom,
-                            'unit_price': 200,
-                            'description': 'Test description1',
-                            'product': self.product.id,
-                        }, {
-                            'quantity': 1,
-                            'unit': self.uom,
-                            'unit_price': 500,
-                            'description': 'Gift Card',
-                            'product': gift_card_product,
-                            'recipient_email': 'test@gift_card.com',
+                    'lines': [('create', [{
+                        'type': 'line',
+                        'quantity': 1,
+                        'unit': self.uom,
+                        'unit_price': 10,
+                        'description': 'Gift card',
+                    }])],
+                }])
+                gift_card1, _, _, _, _, _ = GiftCard.create([{
+                    'amount': Decimal('150'),
+                    'state': 'active',
+                }, {
+                    # Sold gift cards are grouped with the others
+                    'amount': Decimal('10'),
+                    'state': 'active',
+                    'sale_line': sale.lines[0].id,
+                }, {
+                    # Gift cards are grouped by month of activation
+                    'amount': Decimal('70'),
+                    'state': 'active',
+                    'activation_date': date(2014, 5, 10),
+                }, {
+                    'amount': Decimal('50'),
+                    'state': 'active',
+                }, {
+                    'amount': Decimal('40'),
+                    'currency': eur.id,
+                    'state': 'active',
+                }, {
+                    'amount': Decimal('1000'),
+                    'state': 'draft',
+                }])
+                GiftCard.update_balances({
+                    gift_card1.id: (Decimal('20'), Decimal('30')),
+                })
+
+                usd_liability, old_liability = Liability.search([
+                    ('currency', '=', self.usd.id),
+                ])
+                self.assertEqual(
+                    (old_liability.year, old_liability.month), (2014, 5)
+                )
+                self.assertEqual(old_liability.amount, Decimal('70'))
+                self.assertEqual(usd_liability.gift_card_count, 3)
+                self.assertEqual(usd_liability.amount, Decimal('210'))
+                self.assertEqual(
+                    usd_liability.amount_authorized, Decimal('20')
+                )
+                self.assertEqual(usd_liability.amount_captured, Decimal('30'))
+                self.assertEqual(
+                    usd_liability.amount_available, Decimal('160')
+                )
+                self.assertEqual(usd_liability.year, date.today().year)
+                self.assertEqual(usd_liability.month, date.today().month)
+                # The gift cards not sold are in the default company
+                self.assertEqual(usd_liability.company, self.company)
+
+                eur_liability, = Liability.search([
+                    ('currency', '=', eur.id),
+                ])
+                self.assertEqual(eur_liability.amount_available, Decimal('40'))
+
+    def test0079_gift_card_balance_inquiry(self):
+        """
+        Test the balance inquiry of a gift card by its number
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+
+                gift_card, = GiftCard.create([{
+                    'amount': Decimal('150'),
+                    'number': '45671338',
+                }])
+                GiftCard.activate([gift_card])
+
+                self.assertEqual(GiftCard.get_balance('45671338'), {
+                    'number': '45671338',
+                    'state': 'active',
+                    'currency': 'USD',
+                    'amount_available': Decimal('150'),
+                })
+
+                GiftCard.update_balances({
+                    gift_card.id: (Decimal('20'), Decimal('30')),
+                })
+                self.assertEqual(
+                    GiftCard.get_balance('45671338')['amount_available'],
+                    Decimal('100')
+                )
+
+                self.assertIsNone(GiftCard.get_balance('00000000'))
+
+                # The balance is cached until the gift card changes
+                GiftCard.get_balance('45671338')
+                self.assertEqual(
+                    GiftCard._balance_cache.get('45671338')[1]['state'],
+                    'active'
+                )
+
+                # Changes of other gift cards keep the cached balance
+                other_gift_card, = GiftCard.create([{
+                    'amount': Decimal('10'),
+                    'number': '45671339',
+                    'state': 'active',
+                }])
+                GiftCard.update_balances({
+                    other_gift_card.id: (Decimal('0'), Decimal('5')),
+                })
+                self.assertTrue(GiftCard._balance_cache.get('45671338'))
+
+                GiftCard.cancel([gift_card])
+                self.assertIsNone(GiftCard._balance_cache.get('45671338'))
+                self.assertEqual(
+                    GiftCard.get_balance('45671338')['state'], 'canceled'
+                )
+
+    def test0080_test_gift_card_report(self):
+        """
+        Test Gift Card report
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+        GiftCardReport = POOL.get('gift_card.gift_card', type='report')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+
+                gift_card, = GiftCard.create([{
+                    'amount': Decimal('200'),
+                    'number': '45671338',
+                    'state': 'active',
+                }])
+
+                val = GiftCardReport.execute([gift_card.id], {})
+
+                self.assert_(val)
+                # Assert report name
+                self.assertEqual(val[3], 'Gift Card')
+
+    def test0085_gift_card_report_cache(self):
+        """
+        Test the report of a gift card is saved until the gift card changes
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+        GiftCardReport = POOL.get('gift_card.gift_card', type='report')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+
+                draft_gift_card, gift_card = GiftCard.create([{
+                    'amount': Decimal('200'),
+                    'number': '45671337',
+                    'state': 'draft',
+                }, {
+                    'amount': Decimal('200'),
+                    'number': '45671338',
+                    'state': 'active',
+                }])
+
+                # Draft gift cards can still change
+                GiftCardReport.execute([draft_gift_card.id], {})
+                self.assertFalse(draft_gift_card.report_cache)
+
+                val = GiftCardReport.execute([gift_card.id], {})
+                self.assertEqual(gift_card.report_format, val[0])
+                self.assertEqual(str(gift_card.report_cache), str(val[1]))
+
+                # Reprint returns the saved report
+                self.assertEqual(
+                    str(GiftCardReport.execute([gift_card.id], {})[1]),
+                    str(val[1])
+                )
+
+                # The report printed another day is rendered again
+                GiftCard.write([gift_card], {'report_cache_key': 'en_US,'})
+                GiftCardReport.execute([gift_card.id], {})
+                self.assertEqual(
+                    gift_card.report_cache_key,
+                    GiftCardReport.get_cache_key()
+                )
+                self.assertFalse(GiftCardReport.__rpc__['execute'].readonly)
+
+                GiftCard.write([gift_card], {'is_email_sent': True})
+                self.assertTrue(gift_card.report_cache)
+
+                GiftCard.write([gift_card], {'recipient_name': 'John Doe'})
+                self.assertFalse(gift_card.report_cache)
+
+                # Several gift cards printed together are not saved
+                GiftCardReport.execute([gift_card.id, draft_gift_card.id], {})
+                self.assertFalse(gift_card.report_cache)
+
+    def test0090_test_gift_card_deletion(self):
+        """
+        Test that Gift Card should not be deleted in active state
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+
+                gift_card, = GiftCard.create([{
+                    'amount': Decimal('200'),
+                    'number': '45671338',
+                    'state': 'active',
+                }])
+
+                with self.assertRaises(Exception):
+                    GiftCard.delete([gift_card])
+
+                # Try to delete gift card in some other state and it will
+                # be deleted
+                gift_card, = GiftCard.create([{
+                    'amount': Decimal('200'),
+                    'number': '45671339',
+                    'state': 'draft',
+                }])
+
+                GiftCard.delete([gift_card])
+
+    def test0100_send_virtual_gift_cards(self):
+        """
+        Check if virtual gift cards are sent through email
+        """
+        Sale = POOL.get('sale.sale')
+        GiftCard = POOL.get('gift_card.gift_card')
+        Invoice = POOL.get('account.invoice')
+        Configuration = POOL.get('gift_card.configuration')
+        SaleLine = POOL.get('sale.line')
+        EmailQueue = POOL.get('email.queue')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+
+            self.setup_defaults()
+
+            gift_card_product = self.create_product(
+                type='service', mode='virtual', is_gift_card=True
+            )
+
+            with Transaction().set_context({'company': self.company.id}):
+
+                Configuration.create([{
+                    'liability_account': self._get_account_by_kind('revenue').id
+                }])
+                gc_price, _, = gift_card_product.gift_card_prices
+                sale, = Sale.create([{
+                    'reference': 'Sale1',
+                    'sale_date': date.today(),
+                    'invoice_address': self.party1.addresses[0].id,
+                    'shipment_address': self.party1.addresses[0].id,
+                    'party': self.party1.id,
+                    'lines': [
+                        ('create', [{
+                            'type': 'line',
+                            'quantity': 2,
+                            'unit': self.uom,
+                            'unit_price': 200,
+                            'description': 'Test description1',
+                            'product': self.product.id,
+                        }, {
+                            'quantity': 1,
+                            'unit': self.uom,
+                            'unit_price': 500,
+                            'description': 'Gift Card',
+                            'product': gift_card_product,
+                            'recipient_email': 'test@gift_card.com',
+                            'recipient_name': 'John Doe',
+                            'gc_price': gc_price.id
+                        }, {
+                            'type': 'comment',
+                            'description': 'Test line',
+                        }])
+                    ]
+
+                }])
+
+                gift_card_line, = SaleLine.search([
+                    ('sale', '=', sale.id),
+                    ('product', '=', gift_card_product.id),
+                ])
+
+                self.assertEqual(
+                    gift_card_line.gift_card_delivery_mode, 'virtual'
+                )
+
+                Sale.quote([sale])
+
+                Sale.confirm([sale])
+
+                # No gift card yet
+                self.assertFalse(
+                    GiftCard.search([('sale_line', '=', gift_card_line.id)])
+                )
+
+                # No Email is being sent yet
+                self.assertFalse(
+                    EmailQueue.search([
+                        ('to_addrs', '=', gift_card_line.recipient_email),
+                    ])
+                )
+
+                self.SalePayment.create([{
+                    'sale': sale.id,
+                    'amount': Decimal('1000'),
+                    'gateway': self.create_payment_gateway('manual'),
+                    'credit_account': self.party1.account_receivable.id,
+                }])
+
+                Sale.process([sale])
+
+                # Gift card is created
+                self.assertTrue(
+                    GiftCard.search([('sale_line', '=', gift_card_line.id)])
+                )
+
+                self.assertEqual(
+                    GiftCard.search(
+                        [('sale_line', '=', gift_card_line.id)], count=True
+                    ), 1
+                )
+
+                self.assertEqual(Invoice.search([], count=True), 1)
+
+                gift_card, = GiftCard.search([
+                    ('sale_line', '=', gift_card_line.id)
+                ])
+
+                self.assertEqual(
+                    gift_card.recipient_email, gift_card_line.recipient_email
+                )
+
+                self.assertEqual(
+                    gift_card.recipient_name, gift_card_line.recipient_name
+                )
+
+                # Email is sent later, not while processing the sale
+                self.assertFalse(
+                    EmailQueue.search([
+                        ('to_addrs', '=', gift_card_line.recipient_email),
+                    ])
+                )
+                self.assertFalse(gift_card.is_email_sent)
+
+                GiftCard.send_pending_emails()
+
+                # Email is being sent
+                self.assertTrue(
+                    EmailQueue.search([
+                        ('to_addrs', '=', gift_card_line.recipient_email),
+                    ])
+                )
+                self.assertTrue(gift_card.is_email_sent)
+                # The report emailed is not saved on the gift card
+                self.assertFalse(gift_card.report_cache)
+
+    def test0110_test_sending_email_multiple_times(self):
+        """
+        Test that email should not be sent multiple times for gift card
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+        EmailQueue = POOL.get('email.queue')
+        Sale = POOL.get('sale.sale')
+        SaleLine = POOL.get('sale.line')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+                gift_card_product = self.create_product(
+                    type='service', mode='virtual', is_gift_card=True,
+                )
+
+                gc_price, _, = gift_card_product.gift_card_prices
+
+                sale, = Sale.create([{
+                    'reference': 'Sale1',
+                    'sale_date': date.today(),
+                    'invoice_address': self.party1.addresses[0].id,
+                    'shipment_address': self.party1.addresses[0].id,
+                    'party': self.party1.id,
+                    'lines': [
+                        ('create', [{
+                            'type': 'line',
+                            'quantity': 2,
+                            'unit': self.uom,
+                            'unit_price': 200,
+                            'description': 'Test description1',
+                            'product': self.product.id,
+                        }, {
+                            'quantity': 1,
+                            'unit': self.uom,
+                            'unit_price': 500,
+                            'description': 'Gift Card',
+                            'product': gift_card_product,
+                            'recipient_email': 'test@gift_card.com',
                             'recipient_name': 'John Doe',
                             'gc_price': gc_price.id,
                         }, {
@@ -1299,8 +2067,15 @@ class TestGiftCard(TestBase):
                 )
                 self.assertFalse(gift_card.is_email_sent)
 
-                # Send email by activating gift card
+                # Email is not sent for draft gift cards
+                GiftCard.send_pending_emails()
+                self.assertFalse(gift_card.is_email_sent)
+
+                # Activating the gift card queues it for sending
                 GiftCard.activate([gift_card])
+                self.assertFalse(gift_card.is_email_sent)
+
+                GiftCard.send_pending_emails()
 
                 # Email is being sent
                 self.assertEqual(
@@ -1311,7 +2086,7 @@ class TestGiftCard(TestBase):
                 self.assertTrue(gift_card.is_email_sent)
 
                 # Try sending email again
-                GiftCard.activate([gift_card])
+                GiftCard.send_pending_emails()
 
                 # Email is not sent
                 self.assertEqual(
@@ -1320,6 +2095,23 @@ class TestGiftCard(TestBase):
                     ], count=True), 1
                 )
 
+    def test0111_email_templates_are_cached(self):
+        """
+        Test that the email templates are compiled once per process
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            html_template, text_template = \
+                GiftCard()._get_email_templates()
+
+            self.assertEqual(html_template.name, 'gift_card_html.html')
+            self.assertEqual(text_template.name, 'gift_card_text.html')
+            self.assertEqual(
+                GiftCard()._get_email_templates(),
+                (html_template, text_template)
+            )
+
     def test0112_validate_product_type_and_mode(self):
         """
         Check if gift card product is service product for virtual mode and
@@ -1370,6 +2162,40 @@ class TestGiftCard(TestBase):
                 )
                 self.assert_(goods_product)
 
+    def test0113_email_receivers_are_cached(self):
+        """
+        Test that the receivers of gift card emails are cached until a user
+        or a group is changed
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+        ModelData = POOL.get('ir.model.data')
+        Group = POOL.get('res.group')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            group = Group(ModelData.get_id(
+                "gift_card", "gift_card_email_receivers"
+            ))
+
+            self.assertEqual(GiftCard.get_email_receivers(), [])
+
+            user, = self.User.create([{
+                'name': 'Gift Card Manager',
+                'login': 'gift_card_manager',
+                'email': 'manager@example.com',
+                'groups': [('add', [group.id])],
+            }])
+            self.assertEqual(
+                GiftCard.get_email_receivers(), ['manager@example.com']
+            )
+
+            self.User.write([user], {'email': 'gc@example.com'})
+            self.assertEqual(
+                GiftCard.get_email_receivers(), ['gc@example.com']
+            )
+
+            Group.write([group], {'users': [('remove', [user.id])]})
+            self.assertEqual(GiftCard.get_email_receivers(), [])
+
     def test0115_test_gc_min_max(self):
         """
         Test gift card minimum and maximum amounts on product template
@@ -1621,134 +2447,502 @@ class TestGiftCard(TestBase):
 
             with Transaction().set_context({'company': self.company.id}):
 
-                gateway = self.create_payment_gateway(method='manual')
-
-                # Authorise Payment transaction
-                payment_transaction = PaymentTransaction(
-                    description="Payment Transaction 1",
-                    party=self.party1.id,
-                    address=self.party1.addresses[0].id,
-                    amount=Decimal('70'),
-                    currency=self.company.currency.id,
-                    gateway=gateway.id,
-                    credit_account=self.party1.account_receivable.id,
+                gateway = self.create_payment_gateway(method='manual')
+
+                # Authorise Payment transaction
+                payment_transaction = PaymentTransaction(
+                    description="Payment Transaction 1",
+                    party=self.party1.id,
+                    address=self.party1.addresses[0].id,
+                    amount=Decimal('70'),
+                    currency=self.company.currency.id,
+                    gateway=gateway.id,
+                    credit_account=self.party1.account_receivable.id,
+                )
+                payment_transaction.save()
+
+                PaymentTransaction.authorize([payment_transaction])
+
+                self.assertEqual(payment_transaction.state, 'authorized')
+
+                # Settle Payment transactions
+                PaymentTransaction.settle([payment_transaction])
+
+                self.assertEqual(payment_transaction.state, 'posted')
+
+                # Capture Payment transactions
+                payment_transaction = PaymentTransaction(
+                    description="Payment Transaction 1",
+                    party=self.party1.id,
+                    address=self.party1.addresses[0].id,
+                    amount=Decimal('70'),
+                    currency=self.company.currency.id,
+                    gateway=gateway.id,
+                    credit_account=self.party1.account_receivable.id,
+                )
+                payment_transaction.save()
+
+                PaymentTransaction.capture([payment_transaction])
+
+                self.assertEqual(payment_transaction.state, 'posted')
+
+    def test0150_giftcard_redeem_wizard(self):
+        """
+        Tests the gift card redeem wizard.
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+        GCRedeemWizard = POOL.get('gift_card.redeem.wizard', type='wizard')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+
+                active_gift_card, = GiftCard.create([{
+                    'amount': Decimal('150'),
+                    'number': '45671338',
+                    'state': 'draft',
+                }])
+
+                gateway = self.create_payment_gateway()
+
+                with Transaction().set_context(
+                    active_ids=[active_gift_card.id]
+                ):
+                    session_id, start_state, end_state = GCRedeemWizard.create()
+                    data = {
+                        start_state: {
+                            'name': 'start',
+                            'gateway': gateway.id,
+                            'description': 'This is a description.',
+                            'party': self.party1.id,
+                            'address': self.party1.addresses[0].id,
+                            'amount': Decimal('100'),
+                            'gift_card': active_gift_card.id,
+                            'currency': self.usd,
+                        },
+                    }
+
+                    # Trying to redeem GC in draft state, error is thrown.
+                    # Note that a domain error is thrown instead of
+                    # check_giftcard_state() being called.
+                    with self.assertRaises(UserError):
+                        GCRedeemWizard.execute(session_id, data, 'redeem')
+
+                    # Test check_giftcard_state(). Draft state error is thrown.
+                    with self.assertRaises(UserError):
+                        GCRedeemWizard(session_id).check_giftcard_state(
+                            active_gift_card
+                        )
+
+                    GiftCard.activate([active_gift_card])
+
+                    # Test the default_start() method.
+                    values = GCRedeemWizard(session_id).default_start({})
+                    self.assertEqual(values['gift_card'], active_gift_card.id)
+                    self.assertEqual(values['gateway'], gateway.id)
+
+                    # Now execute the wizard properly.
+                    GCRedeemWizard.execute(session_id, data, 'redeem')
+                    self.assertEqual(active_gift_card.state, 'active')
+                    self.assertEqual(
+                        active_gift_card.amount_captured,
+                        data[start_state]['amount']
+                    )
+
+                    data[start_state]['amount'] = Decimal('70')
+
+                    # Error thrown because amount available is just 50.
+                    with self.assertRaises(UserError):
+                        GCRedeemWizard.execute(session_id, data, 'redeem')
+
+                    data[start_state]['amount'] = Decimal('-70')
+
+                    # Error thrown because amount is negative.
+                    with self.assertRaises(UserError):
+                        GCRedeemWizard.execute(session_id, data, 'redeem')
+
+                    data[start_state]['amount'] = Decimal('50')
+                    GCRedeemWizard.execute(session_id, data, 'redeem')
+                    self.assertEqual(active_gift_card.state, 'used')
+                    self.assertEqual(
+                        active_gift_card.amount_available, Decimal('0')
+                    )
+
+                    # Now the gift card has already been used, cannot run
+                    # wizard on it once again.
+                    with self.assertRaises(UserError):
+                        GCRedeemWizard(session_id).check_giftcard_state(
+                            active_gift_card
+                        )
+
+    def test0152_redeem_gift_card_with_idempotency_key(self):
+        """
+        Redemptions retried with the same idempotency key redeem the gift
+        card only once
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+
+                gift_card, = GiftCard.create([{
+                    'amount': Decimal('150'),
+                    'number': '45671338',
+                    'state': 'active',
+                }])
+
+                # No gateway for gift cards yet
+                with self.assertRaises(UserError):
+                    GiftCard.redeem('45671338', Decimal('30'), self.party1.id)
+
+                self.create_payment_gateway()
+
+                result = GiftCard.redeem(
+                    '45671338', Decimal('30'), self.party1.id,
+                    idempotency_key='order-1', description='Order 1'
+                )
+                transaction = PaymentTransaction(result['transaction'])
+                self.assertEqual(result, {
+                    'transaction': transaction.id,
+                    'gift_card': '45671338',
+                    'state': 'posted',
+                    'amount': Decimal('30'),
+                    'currency': 'USD',
+                })
+                self.assertEqual(transaction.idempotency_key, 'order-1')
+                self.assertEqual(gift_card.amount_available, Decimal('120'))
+
+                # The retry returns the first redemption
+                self.assertEqual(
+                    GiftCard.redeem(
+                        '45671338', Decimal('30'), self.party1.id,
+                        idempotency_key='order-1'
+                    ), result
+                )
+                self.assertEqual(gift_card.amount_available, Decimal('120'))
+
+                # The key can not be reused for another redemption
+                with self.assertRaises(UserError):
+                    GiftCard.redeem(
+                        '45671338', Decimal('25'), self.party1.id,
+                        idempotency_key='order-1'
+                    )
+                with self.assertRaises(UserError):
+                    GiftCard.redeem(
+                        '00000000', Decimal('30'), self.party1.id,
+                        idempotency_key='order-1'
+                    )
+
+                GiftCard.redeem(
+                    '45671338', Decimal('20'), self.party1.id,
+                    idempotency_key='order-2'
+                )
+                self.assertEqual(gift_card.amount_available, Decimal('100'))
+
+                transaction_copy, = PaymentTransaction.copy([transaction])
+                self.assertIsNone(transaction_copy.idempotency_key)
+
+                with self.assertRaises(UserError):
+                    GiftCard.redeem('00000000', Decimal('20'), self.party1.id)
+
+                with self.assertRaises(UserError):
+                    GiftCard.redeem('45671338', Decimal('200'), self.party1.id)
+
+                # Redemption checking the currency with a given address
+                result = GiftCard.redeem(
+                    '45671338', Decimal('10'), self.party1.id,
+                    currency='USD', address=self.party1.addresses[0].id
+                )
+                self.assertEqual(result['state'], 'posted')
+                self.assertEqual(gift_card.amount_available, Decimal('90'))
+
+                with self.assertRaises(UserError):
+                    GiftCard.redeem(
+                        '45671338', Decimal('10'), self.party1.id,
+                        currency='EUR'
+                    )
+
+    def test0152_redemption_gateway_rolled_back(self):
+        """
+        A gateway created in a transaction which is rolled back is not used
+        to redeem gift cards
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+                gateway = self.create_payment_gateway()
+                self.assertEqual(GiftCard.get_redemption_gateway(), gateway)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+                GiftCard.create([{
+                    'amount': Decimal('150'),
+                    'number': '45671338',
+                    'state': 'active',
+                }])
+
+                self.assertIsNone(GiftCard.get_redemption_gateway())
+                with self.assertRaises(UserError):
+                    GiftCard.redeem('45671338', Decimal('30'), self.party1.id)
+
+    def test0153_redeem_gift_cards_in_batch(self):
+        """
+        Redeem many gift cards in one call, invalid entries being reported
+        without aborting the batch
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+
+                gift_card1, gift_card2, gift_card3 = GiftCard.create([{
+                    'amount': Decimal('100'),
+                    'number': '1001',
+                    'state': 'active',
+                }, {
+                    'amount': Decimal('50'),
+                    'number': '1002',
+                    'state': 'active',
+                }, {
+                    'amount': Decimal('50'),
+                    'number': '1003',
+                    'state': 'draft',
+                }])
+                self.create_payment_gateway()
+
+                results = GiftCard.redeem_batch([
+                    ('1001', Decimal('60')),
+                    ('1002', Decimal('50')),
+                    ('1001', Decimal('50')),
+                    ('1003', Decimal('10')),
+                    ('9999', Decimal('10')),
+                    ('1002', Decimal('-5')),
+                    ('1001', Decimal('40')),
+                ], self.party1.id, description='Settlement')
+
+                self.assertEqual(
+                    [r.get('state') for r in results], [
+                        'posted', 'posted', None, None, None, None, 'posted',
+                    ]
+                )
+                self.assertEqual(
+                    [r['gift_card'] for r in results],
+                    ['1001', '1002', '1001', '1003', '9999', '1002', '1001']
+                )
+                self.assertTrue(all(
+                    'error' in r for r in results[2:6]
+                ))
+
+                self.assertEqual(gift_card1.amount_available, Decimal('0'))
+                self.assertEqual(gift_card2.amount_available, Decimal('0'))
+                self.assertEqual(gift_card3.amount_available, Decimal('50'))
+
+    def test0154_expire_gift_cards(self):
+        """
+        Gift cards whose expiry date is passed are expired by the sweep and
+        the amount left on them is posted as breakage
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+        Configuration = POOL.get('gift_card.configuration')
+        Snapshot = POOL.get('gift_card.balance.snapshot')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({'company': self.company.id}):
+                today = date.today()
+                yesterday = today - timedelta(days=1)
+
+                product = self.create_product(
+                    type='service', mode='virtual', is_gift_card=True
                 )
-                payment_transaction.save()
-
-                PaymentTransaction.authorize([payment_transaction])
-
-                self.assertEqual(payment_transaction.state, 'authorized')
+                self.assertIsNone(product.get_gift_card_expiry_date(today))
+                product.gift_card_validity = 12
+                product.save()
+                self.assertEqual(
+                    product.get_gift_card_expiry_date(date(2014, 1, 31)),
+                    date(2015, 1, 31)
+                )
+                product.gift_card_validity = -1
+                with self.assertRaises(UserError):
+                    product.save()
+
+                gift_card1, gift_card2, gift_card3, gift_card4, gift_card5 = \
+                    GiftCard.create([{
+                        'amount': Decimal('100'),
+                        'number': '1001',
+                        'state': 'active',
+                        'expiry_date': yesterday,
+                    }, {
+                        'amount': Decimal('50'),
+                        'number': '1002',
+                        'state': 'active',
+                        'expiry_date': yesterday,
+                    }, {
+                        'amount': Decimal('40'),
+                        'number': '1003',
+                        'state': 'active',
+                        'expiry_date': today,
+                    }, {
+                        'amount': Decimal('30'),
+                        'number': '1004',
+                        'state': 'active',
+                    }, {
+                        'amount': Decimal('20'),
+                        'number': '1005',
+                        'expiry_date': yesterday,
+                    }])
+                gateway = self.create_payment_gateway()
+                GiftCard.redeem('1001', Decimal('30'), self.party1.id)
 
-                # Settle Payment transactions
-                PaymentTransaction.settle([payment_transaction])
+                # Breakage can not be posted without the liability account
+                with self.assertRaises(UserError):
+                    GiftCard.expire_gift_cards(commit=False)
 
-                self.assertEqual(payment_transaction.state, 'posted')
+                revenue = self._get_account_by_kind('revenue')
+                Configuration.create([{
+                    'liability_account': revenue.id,
+                }])
 
-                # Capture Payment transactions
-                payment_transaction = PaymentTransaction(
-                    description="Payment Transaction 1",
-                    party=self.party1.id,
-                    address=self.party1.addresses[0].id,
-                    amount=Decimal('70'),
-                    currency=self.company.currency.id,
-                    gateway=gateway.id,
-                    credit_account=self.party1.account_receivable.id,
+                # Breakage can not be posted without its account and journal
+                with self.assertRaises(UserError):
+                    GiftCard.expire_gift_cards(commit=False)
+                self.assertEqual(gift_card1.state, 'active')
+
+                Configuration.write([Configuration(1)], {
+                    'breakage_account': revenue.id,
+                    'breakage_journal': gateway.journal.id,
+                })
+                GiftCard.expire_gift_cards(chunk_size=1, commit=False)
+
+                self.assertEqual(gift_card1.state, 'expired')
+                self.assertEqual(gift_card2.state, 'expired')
+                self.assertEqual(gift_card3.state, 'active')
+                self.assertEqual(gift_card4.state, 'active')
+                self.assertEqual(gift_card5.state, 'draft')
+
+                # One move by chunk
+                move1, move2 = gift_card1.breakage_move, \
+                    gift_card2.breakage_move
+                self.assertNotEqual(move1, move2)
+                self.assertEqual(move1.state, 'posted')
+                self.assertEqual(move1.date, today)
+                self.assertEqual(
+                    sorted((line.debit, line.credit) for line in move1.lines),
+                    [(Decimal('0'), Decimal('70')),
+                     (Decimal('70'), Decimal('0'))]
+                )
+                self.assertEqual(
+                    sum(line.debit for line in move2.lines), Decimal('50')
                 )
-                payment_transaction.save()
 
-                PaymentTransaction.capture([payment_transaction])
+                # Expired gift cards can not be redeemed
+                with self.assertRaises(UserError):
+                    GiftCard.redeem('1002', Decimal('10'), self.party1.id)
 
-                self.assertEqual(payment_transaction.state, 'posted')
+                snapshot, = Snapshot.create_snapshots(today)
+                self.assertEqual(snapshot.amount, Decimal('220'))
+                self.assertEqual(snapshot.amount_captured, Decimal('30'))
+                self.assertEqual(snapshot.amount_expired, Decimal('120'))
+                self.assertEqual(snapshot.amount_available, Decimal('70'))
 
-    def test0150_giftcard_redeem_wizard(self):
+    def test0155_capture_more_than_available_in_batch(self):
         """
-        Tests the gift card redeem wizard.
+        Capturing several transactions of the same gift card at once must
+        not redeem more than the amount available
         """
         GiftCard = POOL.get('gift_card.gift_card')
-        GCRedeemWizard = POOL.get('gift_card.redeem.wizard', type='wizard')
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
 
             with Transaction().set_context({'company': self.company.id}):
 
-                active_gift_card, = GiftCard.create([{
-                    'amount': Decimal('150'),
+                gift_card, = GiftCard.create([{
+                    'amount': Decimal('100'),
                     'number': '45671338',
-                    'state': 'draft',
+                    'state': 'active',
                 }])
 
                 gateway = self.create_payment_gateway()
 
-                with Transaction().set_context(
-                    active_ids=[active_gift_card.id]
-                ):
-                    session_id, start_state, end_state = GCRedeemWizard.create()
-                    data = {
-                        start_state: {
-                            'name': 'start',
-                            'gateway': gateway.id,
-                            'description': 'This is a description.',
-                            'party': self.party1.id,
-                            'address': self.party1.addresses[0].id,
-                            'amount': Decimal('100'),
-                            'gift_card': active_gift_card.id,
-                            'currency': self.usd,
-                        },
-                    }
-
-                    # Trying to redeem GC in draft state, error is thrown.
-                    # Note that a domain error is thrown instead of
-                    # check_giftcard_state() being called.
-                    with self.assertRaises(UserError):
-                        GCRedeemWizard.execute(session_id, data, 'redeem')
+                transactions = PaymentTransaction.create([{
+                    'description': 'Payment Transaction %s' % index,
+                    'party': self.party1.id,
+                    'address': self.party1.addresses[0].id,
+                    'amount': Decimal('40'),
+                    'currency': self.company.currency.id,
+                    'gateway': gateway.id,
+                    'gift_card': gift_card.id,
+                    'credit_account': self.party1.account_receivable.id,
+                } for index in range(3)])
 
-                    # Test check_giftcard_state(). Draft state error is thrown.
-                    with self.assertRaises(UserError):
-                        GCRedeemWizard(session_id).check_giftcard_state(
-                            active_gift_card
-                        )
+                with self.assertRaises(UserError):
+                    PaymentTransaction.capture(transactions)
 
-                    GiftCard.activate([active_gift_card])
+                # A request rolls the whole capture back, so only check that
+                # the ledger did not drift from the transactions
+                self.assertEqual(GiftCard.reconcile_balances([gift_card]), [])
 
-                    # Test the default_start() method.
-                    values = GCRedeemWizard(session_id).default_start({})
-                    self.assertEqual(values['gift_card'], active_gift_card.id)
-                    self.assertEqual(values['gateway'], gateway.id)
+    def test0156_post_transactions_of_same_gift_cards(self):
+        """
+        Posting transactions together sets to used state the gift cards
+        they exhaust
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
 
-                    # Now execute the wizard properly.
-                    GCRedeemWizard.execute(session_id, data, 'redeem')
-                    self.assertEqual(active_gift_card.state, 'active')
-                    self.assertEqual(
-                        active_gift_card.amount_captured,
-                        data[start_state]['amount']
-                    )
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
 
-                    data[start_state]['amount'] = Decimal('70')
+            with Transaction().set_context({'company': self.company.id}):
 
-                    # Error thrown because amount available is just 50.
-                    with self.assertRaises(UserError):
-                        GCRedeemWizard.execute(session_id, data, 'redeem')
+                gift_card1, gift_card2 = GiftCard.create([{
+                    'amount': Decimal('100'),
+                    'number': '45671338',
+                    'state': 'active',
+                }, {
+                    'amount': Decimal('100'),
+                    'number': '45671339',
+                    'state': 'active',
+                }])
 
-                    data[start_state]['amount'] = Decimal('-70')
+                gateway = self.create_payment_gateway()
 
-                    # Error thrown because amount is negative.
-                    with self.assertRaises(UserError):
-                        GCRedeemWizard.execute(session_id, data, 'redeem')
+                transactions = PaymentTransaction.create([{
+                    'description': 'Payment Transaction',
+                    'party': self.party1.id,
+                    'address': self.party1.addresses[0].id,
+                    'amount': amount,
+                    'currency': self.company.currency.id,
+                    'gateway': gateway.id,
+                    'gift_card': gift_card.id,
+                    'credit_account': self.party1.account_receivable.id,
+                } for gift_card, amount in [
+                    (gift_card1, Decimal('60')),
+                    (gift_card1, Decimal('40')),
+                    (gift_card2, Decimal('50')),
+                ]])
+                PaymentTransaction.write(transactions, {'state': 'completed'})
 
-                    data[start_state]['amount'] = Decimal('50')
-                    GCRedeemWizard.execute(session_id, data, 'redeem')
-                    self.assertEqual(active_gift_card.state, 'used')
-                    self.assertEqual(
-                        active_gift_card.amount_available, Decimal('0')
-                    )
+                PaymentTransaction.post(transactions)
 
-                    # Now the gift card has already been used, cannot run
-                    # wizard on it once again.
-                    with self.assertRaises(UserError):
-                        GCRedeemWizard(session_id).check_giftcard_state(
-                            active_gift_card
-                        )
+                self.assertEqual(gift_card1.amount_available, Decimal('0'))
+                self.assertEqual(gift_card1.state, 'used')
+                self.assertEqual(gift_card2.amount_available, Decimal('50'))
+                self.assertEqual(gift_card2.state, 'active')
 
     def test0200_test_sale_payment_wizard_for_gift_card(self):
         """
@@ -1824,6 +3018,64 @@ class TestGiftCard(TestBase):
             self.assertEqual(payment.provider, gift_card_gateway.provider)
             self.assertEqual(payment.gift_card, active_gift_card)
 
+    def test0205_payments_using_same_gift_card(self):
+        """
+        Check payments using the same gift card are validated together
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+        Configuration = POOL.get('gift_card.configuration')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            Configuration.create([{
+                'liability_account': self._get_account_by_kind('revenue').id
+            }])
+
+            gift_card, = GiftCard.create([{
+                'number': 'A1234',
+                'amount': Decimal('100'),
+                'currency': self.company.currency.id,
+                'state': 'active'
+            }])
+
+            sale, = self.Sale.create([{
+                'reference': 'Test Sale',
+                'currency': self.company.currency.id,
+                'party': self.party1.id,
+                'invoice_address': self.party1.addresses[0].id,
+                'shipment_address': self.party1.addresses[0].id,
+                'company': self.company.id,
+                'invoice_method': 'manual',
+                'shipment_method': 'manual',
+                'lines': [('create', [{
+                    'description': 'Some item',
+                    'unit_price': Decimal('150'),
+                    'quantity': 1
+                }])]
+            }])
+
+            gift_card_gateway = self.create_payment_gateway(
+                method='gift_card', provider='self'
+            )
+
+            values = {
+                'sale': sale.id,
+                'amount': Decimal('60'),
+                'gateway': gift_card_gateway,
+                'gift_card': gift_card.id,
+                'credit_account': self.party1.account_receivable.id,
+            }
+
+            # Each payment fits in the gift card but not both of them
+            with self.assertRaises(UserError):
+                self.SalePayment.create([values, values])
+
+            payment1, payment2 = self.SalePayment.create([
+                values, dict(values, amount=Decimal('40'))
+            ])
+            self.assertEqual(payment1.gift_card, payment2.gift_card)
+
     def test0210_partial_payment_using_gift_card(self):
         """
         Check partial payment using cash, credit card and gift card
@@ -2079,6 +3331,189 @@ class TestGiftCard(TestBase):
                     4
                 )
 
+                SaleLine = POOL.get('sale.line')
+                gift_card_lines = [
+                    line for line in sale.lines if line.is_gift_card
+                ]
+                self.assertEqual(
+                    SaleLine.get_gift_card_quantities_paid(gift_card_lines),
+                    dict((line.id, 1) for line in gift_card_lines)
+                )
+                self.assertEqual(
+                    set(Invoice.get_gift_card_sale_lines([invoice])),
+                    set(gift_card_lines)
+                )
+
+    def test3010_gift_cards_of_many_sales(self):
+        """
+        Check gift cards are created for all the sales processed together
+        """
+        Sale = POOL.get('sale.sale')
+        SaleLine = POOL.get('sale.line')
+        GiftCard = POOL.get('gift_card.gift_card')
+        Configuration = POOL.get('gift_card.configuration')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+
+            self.setup_defaults()
+            gift_card_product = self.create_product(is_gift_card=True)
+
+            with Transaction().set_context({'company': self.company.id}):
+
+                Configuration.create([{
+                    'liability_account': self._get_account_by_kind('revenue').id
+                }])
+
+                gc_price, _, = gift_card_product.gift_card_prices
+                sales = Sale.create([{
+                    'reference': 'Sale%d' % i,
+                    'sale_date': date.today(),
+                    'invoice_address': self.party1.addresses[0].id,
+                    'shipment_address': self.party1.addresses[0].id,
+                    'party': self.party1.id,
+                    'lines': [
+                        ('create', [{
+                            'quantity': i,
+                            'unit': self.uom,
+                            'unit_price': 500,
+                            'description': 'Gift Card',
+                            'product': gift_card_product,
+                            'gc_price': gc_price,
+                        }, {
+                            'quantity': 1,
+                            'unit': self.uom,
+                            'unit_price': 20,
+                            'description': 'Product',
+                            'product': self.product,
+                        }])
+                    ]
+                } for i in range(1, 4)])
+
+                Sale.quote(sales)
+                Sale.confirm(sales)
+
+                gateway = self.create_payment_gateway('manual')
+                self.SalePayment.create([{
+                    'sale': sale.id,
+                    'amount': sale.total_amount,
+                    'gateway': gateway,
+                    'credit_account': self.party1.account_receivable.id,
+                } for sale in sales])
+
+                Sale.process(sales)
+
+                for i, sale in enumerate(sales, 1):
+                    gift_card_line = sale.lines[0]
+                    self.assertEqual(len(gift_card_line.gift_cards), i)
+                    self.assertTrue(all(
+                        g.state == 'active' and g.amount == 500 and
+                        g.origin == sale
+                        for g in gift_card_line.gift_cards
+                    ))
+
+                lines = [line for sale in sales for line in sale.lines]
+                self.assertEqual(
+                    SaleLine.get_gift_card_quantities_created(lines),
+                    dict((line.id, len(line.gift_cards)) for line in lines)
+                )
+
+                # Nothing more to create
+                self.assertEqual(
+                    SaleLine.create_gift_cards_for_lines(lines), []
+                )
+                self.assertEqual(GiftCard.search([], count=True), 6)
+
+    @unittest.skipIf(
+        backend.name() == 'sqlite', "Skip concurrency test on SQlite"
+    )
+    def test9999_concurrent_captures(self):
+        """
+        Capture transactions of the same gift card from parallel threads
+        and check that the gift card is never overdrawn.
+
+        * This test is expected to work only on postgres
+        * This should be the last test since this breaks the rule to commit
+          within the test creating records
+        """
+        GiftCard = POOL.get('gift_card.gift_card')
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        captures, amount, retries = 10, Decimal('30'), 10
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as txn:
+            self.setup_defaults()
+            context = {'company': self.company.id}
+
+            with Transaction().set_context(context):
+
+                gift_card, = GiftCard.create([{
+                    'amount': Decimal('100'),
+                    'number': '45671338',
+                    'state': 'active',
+                }])
+
+                gateway = self.create_payment_gateway()
+
+                transaction_ids = map(int, PaymentTransaction.create([{
+                    'description': 'Payment Transaction %s' % index,
+                    'party': self.party1.id,
+                    'address': self.party1.addresses[0].id,
+                    'amount': amount,
+                    'currency': self.company.currency.id,
+                    'gateway': gateway.id,
+                    'gift_card': gift_card.id,
+                    'credit_account': self.party1.account_receivable.id,
+                } for index in range(captures)]))
+
+            txn.cursor.commit()
+
+        results = Queue.Queue(captures)
+
+        def threaded_capture(transaction_id):
+            """
+            Capture the transaction in a new database transaction, retrying
+            a bounded number of times on serialization errors like the
+            dispatcher would.
+            """
+            for count in range(retries, -1, -1):
+                with Transaction().start(
+                        DB_NAME, USER, context=context) as txn:
+                    try:
+                        PaymentTransaction.capture(
+                            [PaymentTransaction(transaction_id)]
+                        )
+                        txn.cursor.commit()
+                    except DatabaseOperationalError:
+                        txn.cursor.rollback()
+                        if count:
+                            continue
+                        results.put('failed')
+                    except UserError:
+                        txn.cursor.rollback()
+                        results.put('rejected')
+                    else:
+                        results.put('captured')
+                    break
+
+        threads = [
+            threading.Thread(target=threaded_capture, args=(transaction_id,))
+            for transaction_id in transaction_ids
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        outcomes = [results.get_nowait() for _ in range(captures)]
+        self.assertEqual(outcomes.count('captured'), 3)
+
+        with Transaction().start(DB_NAME, USER, context=context):
+            gift_card = GiftCard(gift_card.id)
+            self.assertEqual(gift_card.amount_captured, Decimal('90'))
+            self.assertEqual(gift_card.amount_available, Decimal('10'))
+            self.assertEqual(GiftCard.reconcile_balances([gift_card]), [])
+
 
 def suite():
     """
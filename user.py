@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+    user.py
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from trytond.pool import PoolMeta, Pool
+
+__all__ = ['User', 'Group']
+__metaclass__ = PoolMeta
+
+
+class User:
+    "User"
+    __name__ = 'res.user'
+
+    @classmethod
+    def create(cls, vlist):
+        GiftCard = Pool().get('gift_card.gift_card')
+
+        users = super(User, cls).create(vlist)
+        GiftCard._email_receivers_cache.clear()
+        return users
+
+    @classmethod
+    def write(cls, *args):
+        GiftCard = Pool().get('gift_card.gift_card')
+
+        super(User, cls).write(*args)
+
+        actions = iter(args)
+        for users, values in zip(actions, actions):
+            if set(values) & set(['email', 'groups', 'active']):
+                GiftCard._email_receivers_cache.clear()
+                break
+
+    @classmethod
+    def delete(cls, users):
+        GiftCard = Pool().get('gift_card.gift_card')
+
+        super(User, cls).delete(users)
+        GiftCard._email_receivers_cache.clear()
+
+
+class Group:
+    "Group"
+    __name__ = 'res.group'
+
+    @classmethod
+    def create(cls, vlist):
+        GiftCard = Pool().get('gift_card.gift_card')
+
+        groups = super(Group, cls).create(vlist)
+        GiftCard._email_receivers_cache.clear()
+        return groups
+
+    @classmethod
+    def write(cls, *args):
+        GiftCard = Pool().get('gift_card.gift_card')
+
+        super(Group, cls).write(*args)
+        GiftCard._email_receivers_cache.clear()
+
+    @classmethod
+    def delete(cls, groups):
+        GiftCard = Pool().get('gift_card.gift_card')
+
+        super(Group, cls).delete(groups)
+        GiftCard._email_receivers_cache.clear()